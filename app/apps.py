@@ -6,7 +6,7 @@ import threading
 import time
 
 from .app_templates import TEMPLATES
-from .process_utils import spawn_logged, terminate_process_group
+from .process_utils import spawn_logged, terminate_process_groups
 
 logger = logging.getLogger(__name__)
 
@@ -97,8 +97,9 @@ class AppManager:
             self.stop()
             self._launch(name)
 
-    def stop(self):
-        """Stop whatever app is currently running, if any."""
+    def stop(self, timeout=5):
+        """Stop whatever app is currently running, if any, giving it `timeout` seconds
+        to exit before it's killed."""
         with self._lock:
             self._generation += 1  # tells any in-flight restart-monitor to stand down
             if not self._processes:
@@ -107,8 +108,7 @@ class AppManager:
                 return
 
             logger.info(f"Stopping app '{self._current_name}'")
-            for process in self._processes:
-                terminate_process_group(process)
+            terminate_process_groups(self._processes, timeout)
 
             self._processes = []
             self._main_process = None
@@ -0,0 +1,567 @@
+import heapq
+import itertools
+import logging
+import os
+import queue
+import re
+import subprocess
+import threading
+import time
+from concurrent.futures import Future
+
+from .process_utils import terminate_process_group
+
+logger = logging.getLogger(__name__)
+
+# CEC opcodes used to control the TV and track its state (HDMI-CEC 1.4 spec, table 8 onwards).
+OPCODE_IMAGE_VIEW_ON = 0x04
+OPCODE_STANDBY = 0x36
+OPCODE_GIVE_OSD_NAME = 0x46
+OPCODE_SET_OSD_NAME = 0x47
+OPCODE_ROUTING_CHANGE = 0x80
+OPCODE_ACTIVE_SOURCE = 0x82
+OPCODE_GIVE_PHYSICAL_ADDRESS = 0x83
+OPCODE_REPORT_PHYSICAL_ADDRESS = 0x84
+OPCODE_REQUEST_ACTIVE_SOURCE = 0x85
+OPCODE_SET_STREAM_PATH = 0x86
+OPCODE_DEVICE_VENDOR_ID = 0x87
+OPCODE_GIVE_DEVICE_VENDOR_ID = 0x8C
+OPCODE_GIVE_DEVICE_POWER_STATUS = 0x8F
+OPCODE_REPORT_POWER_STATUS = 0x90
+
+BROADCAST = 0x0F
+
+# Logical address -> the name cec-client's scan uses for it
+LOGICAL_ADDRESS_NAMES = (
+    "TV", "Recorder 1", "Recorder 2", "Tuner 1", "Playback 1", "Audio", "Tuner 2", "Tuner 3",
+    "Playback 2", "Recorder 3", "Tuner 4", "Playback 3", "Reserved 1", "Reserved 2", "Free use", "Broadcast",
+)
+
+# CecCommandQueue priorities: lower runs first
+PRIORITY_USER = 0
+PRIORITY_BACKGROUND = 10
+
+# <Report Power Status> operand -> the same wording `pow` prints
+POWER_STATUS_NAMES = {
+    0x00: "on",
+    0x01: "standby",
+    0x02: "in transition from standby to on",
+    0x03: "in transition from on to standby",
+}
+
+# e.g. "TRAFFIC: [           85471]\t>> 0f:82:30:00" -- ">>" received, "<<" sent by us
+TRAFFIC_LINE = re.compile(r"TRAFFIC:.*?(<<|>>)\s*([0-9a-fA-F]{2}(?::[0-9a-fA-F]{2})*)")
+
+# `cec-client scan` output
+SCAN_DEVICE_HEADER = re.compile(r"^device #(\d+):\s*(.*)$")
+SCAN_FIELD = re.compile(r"^([a-z ]+?):\s*(.*)$")
+SCAN_ACTIVE_SOURCE = re.compile(r"currently active source:\s*(.+)")
+SCAN_DEVICE_NUMBER = re.compile(r"\((-?\d+)\)")  # "unknown (-1)" when nothing is active
+POWER_STATUS_LINE = re.compile(r"power status:\s*(.+)")
+
+
+def encode_physical_address(physical_address):
+    """Physical address (e.g. "3.0.0.0") as the two operand bytes CEC sends it as."""
+    nibbles = [int(part, 16) for part in physical_address.split('.')]
+    return bytes([(nibbles[0] << 4) | nibbles[1], (nibbles[2] << 4) | nibbles[3]])
+
+
+def decode_physical_address(data):
+    high, low = data[0], data[1]
+    return f"{high >> 4:x}.{high & 0x0F:x}.{low >> 4:x}.{low & 0x0F:x}"
+
+
+class CecFrame:
+    """One CEC message seen on the bus."""
+    __slots__ = ('initiator', 'destination', 'opcode', 'params', 'outgoing')
+
+    def __init__(self, initiator, destination, opcode, params, outgoing):
+        self.initiator = initiator
+        self.destination = destination
+        self.opcode = opcode        # None for a bare poll
+        self.params = params        # bytes following the opcode
+        self.outgoing = outgoing    # True if we sent it rather than received it
+
+    @classmethod
+    def from_traffic_line(cls, line):
+        """Parse a cec-client TRAFFIC log line, or None if it isn't one."""
+        match = TRAFFIC_LINE.search(line)
+        if not match:
+            return None
+        data = bytes(int(part, 16) for part in match.group(2).split(':'))
+        return cls(data[0] >> 4, data[0] & 0x0F, data[1] if len(data) > 1 else None,
+                   data[2:], match.group(1) == "<<")
+
+    def physical_address(self, offset=0):
+        """Physical address operand at `offset` in params, e.g. "3.0.0.0"."""
+        if len(self.params) < offset + 2:
+            return None
+        return decode_physical_address(self.params[offset:offset + 2])
+
+    def __repr__(self):
+        opcode = "poll" if self.opcode is None else f"{self.opcode:02X}"
+        return f"CecFrame({self.initiator:X}->{self.destination:X} {opcode} {self.params.hex(':')})"
+
+
+class CecClientSession:
+    """One long-lived `cec-client` process that commands are written to over stdin,
+    instead of spawning (and re-initialising the adapter for) a fresh `cec-client -s`
+    per command. Restarted transparently whenever it dies or wedges.
+
+    Runs with traffic logging on so bus messages nobody asked for (e.g. the TV's own
+    remote switching input) reach `frame_listener` as CecFrames as they arrive; they're
+    kept out of command replies."""
+
+    READY_TIMEOUT = 15    # seconds to wait for the adapter to open on (re)start
+    SETTLE_TIME = 0.3     # a command with no expected reply is done once output goes quiet this long
+    READY_MARKER = "waiting for input"
+
+    def __init__(self, command="cec-client -d 9", frame_listener=None):  # -d 9: errors + traffic
+        self.command = command
+        self.frame_listener = frame_listener
+        self._lock = threading.Lock()  # one command in flight at a time
+        self._process = None
+        self._lines = None             # queue.Queue of the current process's output lines
+        # Reply pattern of a command that was abandoned mid-flight (see abort()): its
+        # output is still on its way, so it must be skipped before the next command's.
+        self._discard_until = None
+        self._abort = threading.Event()
+        self._closed = False  # set by close(): no new cec-client is started after it
+
+    def command_output(self, cec_command, timeout, reply_pattern=None):
+        """Send one command and return its output (empty on failure/timeout).
+        `reply_pattern` (a compiled regex) marks the line that completes the reply;
+        without one, the command is done once output has been quiet for SETTLE_TIME."""
+        with self._lock:
+            self._abort.clear()
+            if not self._ensure_running():
+                return ""
+            deadline = time.monotonic() + timeout
+            if self._discard_until is not None and not self._skip_abandoned_reply(deadline):
+                logger.error("cec-client never finished an abandoned command; restarting it")
+                self._restart()
+                return ""
+
+            self._drain()
+            try:
+                self._process.stdin.write(cec_command + "\n")
+                self._process.stdin.flush()
+            except (BrokenPipeError, OSError) as e:
+                logger.warning(f"cec-client went away ({e}); restarting it")
+                self._restart()
+                return ""
+
+            collected = []
+            while True:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    logger.error(f"cec-client command '{cec_command}' timed out after {timeout}s")
+                    if reply_pattern is not None:
+                        # Its reply may still show up later and be mistaken for the next one's.
+                        self._restart()
+                    return "".join(collected)
+                if self._abort.is_set():
+                    logger.info(f"Abandoned in-progress cec-client command '{cec_command}'")
+                    self._discard_until = reply_pattern
+                    return ""
+                wait = min(remaining, 0.1 if reply_pattern is not None else self.SETTLE_TIME)
+                try:
+                    line = self._lines.get(timeout=wait)
+                except queue.Empty:
+                    if reply_pattern is None:
+                        return "".join(collected)
+                    continue
+                if line is None:
+                    logger.warning(f"cec-client exited during '{cec_command}'; restarting it")
+                    self._restart()
+                    return "".join(collected)
+                collected.append(line)
+                if reply_pattern is not None and reply_pattern.search(line):
+                    return "".join(collected)
+
+    def abort(self):
+        """Stop waiting on the in-progress command (e.g. a background scan a user command
+        shouldn't queue behind). cec-client itself still finishes it, so its leftover
+        output is skipped before the next command's reply is read."""
+        self._abort.set()
+
+    def close(self):
+        self._closed = True
+        with self._lock:
+            self._stop()
+
+    def _ensure_running(self):
+        if self._process is not None and self._process.poll() is None:
+            return True
+        self._stop()
+        return self._start()
+
+    def _start(self):
+        if self._closed:
+            return False
+        try:
+            process = subprocess.Popen(
+                self.command, shell=True, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT, text=True, bufsize=1, preexec_fn=os.setsid
+            )
+        except OSError as e:
+            logger.error(f"Failed to start cec-client: {e}")
+            return False
+
+        lines = queue.Queue()
+        threading.Thread(target=self._read_output, args=(process, lines), daemon=True).start()
+        self._process = process
+        self._lines = lines
+        self._discard_until = None
+
+        start = time.monotonic()
+        deadline = start + self.READY_TIMEOUT
+        while time.monotonic() < deadline:
+            try:
+                line = lines.get(timeout=deadline - time.monotonic())
+            except queue.Empty:
+                break
+            if line is None:
+                logger.error("cec-client exited while opening the CEC adapter")
+                self._stop()
+                return False
+            if self.READY_MARKER in line:
+                logger.info(f"cec-client session started ({time.monotonic() - start:.1f}s)")
+                return True
+        logger.error(f"cec-client didn't become ready within {self.READY_TIMEOUT}s")
+        self._stop()
+        return False
+
+    def _stop(self):
+        process, self._process = self._process, None
+        if process is not None:
+            terminate_process_group(process, timeout=2)
+
+    def _restart(self):
+        self._stop()
+        self._start()
+
+    def _drain(self):
+        """Discard any unsolicited output left over from before this command."""
+        while True:
+            try:
+                line = self._lines.get_nowait()
+            except queue.Empty:
+                return
+            if line is None:
+                self._lines.put(None)  # keep the EOF marker for whoever reads next
+                return
+
+    def _skip_abandoned_reply(self, deadline):
+        pattern, self._discard_until = self._discard_until, None
+        while time.monotonic() < deadline:
+            try:
+                line = self._lines.get(timeout=deadline - time.monotonic())
+            except queue.Empty:
+                break
+            if line is None:
+                return False
+            if pattern.search(line):
+                return True
+        return False
+
+    def _read_output(self, process, lines):
+        for line in process.stdout:
+            if "TRAFFIC:" not in line:
+                lines.put(line)
+                continue
+            frame = CecFrame.from_traffic_line(line)
+            if frame is None or self.frame_listener is None:
+                continue
+            try:
+                self.frame_listener(frame)
+            except Exception:
+                logger.exception(f"CEC frame listener failed for {frame!r}")
+        lines.put(None)
+
+
+class CecDevice:
+    """One device from a bus scan."""
+    __slots__ = ('number', 'type_name', 'address', 'vendor', 'osd_name', 'power_status', 'active_source')
+
+    def __init__(self, number, type_name):
+        self.number = number          # logical address, as a string (e.g. "4")
+        self.type_name = type_name    # e.g. "Playback 1"
+        self.address = None           # physical address, e.g. "3.0.0.0"
+        self.vendor = None
+        self.osd_name = None
+        self.power_status = None      # e.g. "on", "standby"
+        self.active_source = False
+
+    def __repr__(self):
+        return f"CecDevice(#{self.number} {self.address} {self.osd_name!r})"
+
+
+class ScanResult:
+    """A bus scan, parsed once and indexed by logical number and physical address."""
+    __slots__ = ('devices', 'by_number', 'by_address', 'active_source_text', 'active_source_number', 'taken_at')
+
+    # scan field name -> CecDevice attribute
+    FIELDS = {
+        'address': 'address',
+        'vendor': 'vendor',
+        'osd string': 'osd_name',
+        'power status': 'power_status',
+    }
+
+    def __init__(self, devices, active_source_text=None, taken_at=None):
+        self.devices = devices
+        self.by_number = {device.number: device for device in devices}
+        self.by_address = {device.address: device for device in devices if device.address}
+        self.active_source_text = active_source_text  # e.g. "Playback 1 (4)", None if not reported
+        match = SCAN_DEVICE_NUMBER.search(active_source_text) if active_source_text else None
+        self.active_source_number = match.group(1) if match else None
+        self.taken_at = time.monotonic() if taken_at is None else taken_at
+
+    @classmethod
+    def parse(cls, scan_output):
+        devices = []
+        current = None
+        active_source_text = None
+        for line in scan_output.splitlines():
+            line = line.strip()
+            header = SCAN_DEVICE_HEADER.match(line)
+            if header:
+                current = CecDevice(header.group(1), header.group(2))
+                devices.append(current)
+                continue
+            active = SCAN_ACTIVE_SOURCE.match(line)
+            if active:
+                active_source_text = active.group(1).strip()
+                continue
+            field = SCAN_FIELD.match(line)
+            if current is None or not field:
+                continue
+            name, value = field.group(1), field.group(2).strip()
+            if name == 'active source':
+                current.active_source = value == 'yes'
+            elif name in cls.FIELDS:
+                setattr(current, cls.FIELDS[name], value)
+        return cls(devices, active_source_text)
+
+    def age(self):
+        return time.monotonic() - self.taken_at
+
+
+class CecBackend:
+    """What TV needs from a CEC adapter. Every method is a single blocking bus
+    transaction, run one at a time from TV's CecCommandQueue; bus traffic from other
+    devices reaches `frame_listener` as CecFrames from the backend's own thread."""
+
+    name = None
+
+    def __init__(self, frame_listener=None):
+        self.frame_listener = frame_listener
+
+    def power_status(self, address, timeout):
+        """Power status name ("on", "standby", ...; see POWER_STATUS_NAMES), or None if
+        the device didn't answer."""
+        raise NotImplementedError
+
+    def power_on(self, address, timeout):
+        raise NotImplementedError
+
+    def standby(self, address, timeout):
+        raise NotImplementedError
+
+    def transmit(self, destination, opcode, params=b"", timeout=10):
+        """Send one message from our own logical address; returns once it's been sent."""
+        raise NotImplementedError
+
+    def scan(self, timeout):
+        """Walk the whole bus. Returns a ScanResult -- an empty one on failure."""
+        raise NotImplementedError
+
+    def abort(self):
+        """Give up on the in-progress transaction if it can be interrupted."""
+
+    def close(self):
+        pass
+
+    def set_active_source(self, physical_address, timeout=10):
+        """Make `physical_address` the active source, whichever device sits there."""
+        self.transmit(BROADCAST, OPCODE_ACTIVE_SOURCE, encode_physical_address(physical_address), timeout)
+
+    def request_active_source(self, timeout=10):
+        """Ask whoever is the active source to say so (answered as bus traffic)."""
+        self.transmit(BROADCAST, OPCODE_REQUEST_ACTIVE_SOURCE, timeout=timeout)
+
+    def _notify(self, frame):
+        if self.frame_listener is None:
+            return
+        try:
+            self.frame_listener(frame)
+        except Exception:
+            logger.exception(f"CEC frame listener failed for {frame!r}")
+
+
+class CecClientBackend(CecBackend):
+    """CecBackend over a persistent `cec-client` process: commands in its text syntax,
+    replies parsed back out of its output. Works with any adapter libcec supports."""
+
+    name = "cec-client"
+    INITIATOR = 1  # cec-client registers as a recording device by default
+
+    # Line that completes each command's reply. Commands not listed (on, standby, tx)
+    # have no reply and finish once output goes quiet.
+    REPLY_PATTERNS = {
+        'pow': re.compile(r"power status:"),
+        'scan': re.compile(r"currently active source:"),
+    }
+
+    def __init__(self, frame_listener=None, command="cec-client -d 9"):
+        super().__init__(frame_listener)
+        self.session = CecClientSession(command, frame_listener=self._notify)
+
+    def power_status(self, address, timeout):
+        match = POWER_STATUS_LINE.search(self._command(f"pow {address}", timeout).lower())
+        return match.group(1).strip() if match else None
+
+    def power_on(self, address, timeout):
+        self._command(f"on {address}", timeout)
+
+    def standby(self, address, timeout):
+        self._command(f"standby {address}", timeout)
+
+    def transmit(self, destination, opcode, params=b"", timeout=10):
+        data = bytes([(self.INITIATOR << 4) | destination, opcode]) + bytes(params)
+        self._command("tx " + data.hex(":").upper(), timeout)
+
+    def scan(self, timeout):
+        return ScanResult.parse(self._command("scan", timeout))
+
+    def abort(self):
+        self.session.abort()
+
+    def close(self):
+        self.session.close()
+
+    def _command(self, cec_command, timeout):
+        reply_pattern = self.REPLY_PATTERNS.get(cec_command.split()[0])
+        return self.session.command_output(cec_command, timeout, reply_pattern)
+
+
+class _QueuedCommand:
+    __slots__ = ('priority', 'sequence', 'operation', 'args', 'key', 'group', 'preemptible', 'future', 'stale')
+
+    def __init__(self, priority, sequence, operation, args, key, group, preemptible=False):
+        self.priority = priority
+        self.sequence = sequence
+        self.operation = operation
+        self.args = args
+        self.key = key
+        self.group = group
+        self.preemptible = preemptible
+        self.future = Future()
+        self.stale = False  # superseded/re-queued; skipped when popped
+
+    def __lt__(self, other):
+        return (self.priority, self.sequence) < (other.priority, other.sequence)
+
+
+class CecCommandQueue:
+    """Runs bus transactions one at a time on a single worker thread, highest priority
+    first (FIFO within a priority), returning a Future per submission.
+
+    - `key`: identical queries (same key) share one transaction -- a submission whose
+      key matches one already queued or running just gets that one's Future.
+    - `group`: a newer submission replaces (cancels) a still-queued one in the same
+      group, e.g. a standby submitted while a power-on is still waiting its turn.
+    - A user-priority submission arriving while a background one submitted as
+      `preemptible` runs calls `on_preempt`, so e.g. a long background scan can be
+      abandoned. Anything else (e.g. a power query) is left to finish: its caller would
+      otherwise get no answer and could mistake that for one. It's called under the
+      queue's lock (so it must only flag the abort), which guarantees the command it
+      interrupts is still the preemptible one, not whatever the worker starts next."""
+
+    def __init__(self, on_preempt=None):
+        self._on_preempt = on_preempt
+        self._condition = threading.Condition()
+        self._heap = []
+        self._sequence = itertools.count()
+        self._queued_by_key = {}    # key -> _QueuedCommand, not yet started
+        self._queued_by_group = {}  # group -> _QueuedCommand, not yet started
+        self._running = None
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def submit(self, operation, *args, priority=PRIORITY_USER, key=None, group=None, preemptible=False):
+        with self._condition:
+            if key is not None:
+                running = self._running
+                if running is not None and running.key == key:
+                    # A user caller now depends on it too, so it's no longer preemptable
+                    running.priority = min(running.priority, priority)
+                    running.preemptible = running.preemptible and preemptible
+                    return running.future
+                queued = self._queued_by_key.get(key)
+                if queued is not None:
+                    queued.preemptible = queued.preemptible and preemptible
+                    if priority < queued.priority:
+                        self._requeue(queued, priority)
+                    return queued.future
+
+            if group is not None:
+                superseded = self._queued_by_group.pop(group, None)
+                if superseded is not None:
+                    self._discard(superseded)
+                    superseded.future.cancel()
+                    logger.info(f"Replaced queued CEC command {superseded.args!r} with a newer {group} request")
+
+            command = _QueuedCommand(priority, next(self._sequence), operation, args, key, group, preemptible)
+            self._push(command)
+
+            running = self._running
+            if running is not None and running.preemptible and priority < running.priority and self._on_preempt:
+                self._on_preempt()
+            self._condition.notify()
+        return command.future
+
+    def _push(self, command):
+        heapq.heappush(self._heap, command)
+        if command.key is not None:
+            self._queued_by_key[command.key] = command
+        if command.group is not None:
+            self._queued_by_group[command.group] = command
+
+    def _discard(self, command):
+        command.stale = True
+        if command.key is not None and self._queued_by_key.get(command.key) is command:
+            del self._queued_by_key[command.key]
+        if command.group is not None and self._queued_by_group.get(command.group) is command:
+            del self._queued_by_group[command.group]
+
+    def _requeue(self, command, priority):
+        """Move a queued command up to `priority`, keeping its Future."""
+        self._discard(command)
+        replacement = _QueuedCommand(priority, next(self._sequence), command.operation, command.args, command.key, command.group,
+                                     command.preemptible)
+        replacement.future = command.future
+        self._push(replacement)
+
+    def _worker(self):
+        while True:
+            with self._condition:
+                while not self._heap:
+                    self._condition.wait()
+                command = heapq.heappop(self._heap)
+                if command.stale:
+                    continue
+                self._discard(command)
+                command.stale = False
+                if not command.future.set_running_or_notify_cancel():
+                    continue
+                self._running = command
+
+            try:
+                command.future.set_result(command.operation(*command.args))
+            except Exception as e:
+                logger.exception(f"CEC command {command.args!r} failed")
+                command.future.set_exception(e)
+            finally:
+                with self._condition:
+                    self._running = None
@@ -0,0 +1,304 @@
+import errno
+import fcntl
+import logging
+import os
+import select
+import struct
+import threading
+import time
+
+from .cec import (
+    BROADCAST, LOGICAL_ADDRESS_NAMES, OPCODE_ACTIVE_SOURCE, OPCODE_DEVICE_VENDOR_ID, OPCODE_GIVE_DEVICE_POWER_STATUS,
+    OPCODE_GIVE_DEVICE_VENDOR_ID, OPCODE_GIVE_OSD_NAME, OPCODE_GIVE_PHYSICAL_ADDRESS, OPCODE_IMAGE_VIEW_ON,
+    OPCODE_REPORT_PHYSICAL_ADDRESS, OPCODE_REPORT_POWER_STATUS, OPCODE_REQUEST_ACTIVE_SOURCE, OPCODE_ROUTING_CHANGE,
+    OPCODE_SET_OSD_NAME, OPCODE_SET_STREAM_PATH, OPCODE_STANDBY, POWER_STATUS_NAMES, CecBackend, CecDevice, CecFrame,
+    ScanResult, decode_physical_address,
+)
+
+logger = logging.getLogger(__name__)
+
+# Linux CEC framework userspace API (include/uapi/linux/cec.h, Documentation/userspace-api/media/cec)
+
+_IOC_WRITE, _IOC_READ = 1, 2
+
+
+def _ioc(direction, number, size):
+    return (direction << 30) | (size << 16) | (ord('a') << 8) | number
+
+
+# struct cec_msg: tx_ts, rx_ts, len, timeout, sequence, flags, msg[16], reply, rx_status,
+# tx_status, tx_arb_lost_cnt, tx_nack_cnt, tx_low_drive_cnt, tx_error_cnt, (padding)
+CEC_MSG = struct.Struct("=QQIIII16sBBBBBBBx")
+# struct cec_log_addrs: log_addr[4], log_addr_mask, cec_version, num_log_addrs, vendor_id,
+# flags, osd_name[15], primary_device_type[4], log_addr_type[4], all_device_types[4], features[4][12]
+CEC_LOG_ADDRS = struct.Struct("=4sHBBII15s4s4s4s48sx")
+# struct cec_event: ts, event, flags, then a 64-byte union (state_change: phys_addr, log_addr_mask)
+CEC_EVENT = struct.Struct("=QIIHH60s")
+
+CEC_ADAP_G_PHYS_ADDR = _ioc(_IOC_READ, 1, 2)
+CEC_ADAP_G_LOG_ADDRS = _ioc(_IOC_READ, 3, CEC_LOG_ADDRS.size)
+CEC_ADAP_S_LOG_ADDRS = _ioc(_IOC_READ | _IOC_WRITE, 4, CEC_LOG_ADDRS.size)
+CEC_TRANSMIT = _ioc(_IOC_READ | _IOC_WRITE, 5, CEC_MSG.size)
+CEC_RECEIVE = _ioc(_IOC_READ | _IOC_WRITE, 6, CEC_MSG.size)
+CEC_DQEVENT = _ioc(_IOC_READ | _IOC_WRITE, 7, CEC_EVENT.size)
+CEC_S_MODE = _ioc(_IOC_WRITE, 9, 4)
+
+CEC_MODE_INITIATOR = 0x01
+CEC_MODE_FOLLOWER = 0x10   # broadcasts and messages addressed to us
+
+CEC_TX_STATUS_OK = 0x01
+CEC_RX_STATUS_OK = 0x01
+CEC_RX_STATUS_FEATURE_ABORT = 0x04  # the "reply" was <Feature Abort>
+
+CEC_EVENT_STATE_CHANGE = 1
+CEC_EVENT_LOST_MSGS = 2
+
+CEC_LOG_ADDR_INVALID = 0xFF
+CEC_OP_CEC_VERSION_1_4 = 5
+CEC_OP_PRIM_DEVTYPE_PLAYBACK = 4
+CEC_LOG_ADDR_TYPE_PLAYBACK = 3
+CEC_OP_ALL_DEVTYPE_PLAYBACK = 0x10
+CEC_OP_POWER_STATUS_ON = 0x00
+CEC_VENDOR_ID_NONE = 0xFFFFFFFF
+
+
+class LinuxCecBackend(CecBackend):
+    """CecBackend over the kernel's CEC framework (/dev/cecN, e.g. the Pi's vc4 HDMI
+    adapter, or the `vivid` driver's virtual one): messages go out as CEC_TRANSMIT
+    ioctls with the kernel waiting for the reply, so there's no process to spawn or
+    text to parse. Incoming traffic is read on a thread that poll()s the device.
+
+    As a follower we're also sent other devices' questions, and answer the ones
+    cec-client did (see _answer): without that the TV leaves the Pi out of its input
+    list and it can't reclaim the screen when the TV wakes."""
+
+    name = "kernel"
+    OSD_NAME = "Magic Mirror"
+    ACTIVE_SOURCE_WAIT = 1.0  # seconds a scan waits for an answer to <Request Active Source>
+
+    def __init__(self, device="/dev/cec0", frame_listener=None):
+        super().__init__(frame_listener)
+        self.device = device
+        self._fd = os.open(device, os.O_RDWR)
+        try:
+            fcntl.ioctl(self._fd, CEC_S_MODE, struct.pack("=I", CEC_MODE_INITIATOR | CEC_MODE_FOLLOWER))
+            self.logical_address = self._claim_logical_address()
+            buffer = bytearray(2)
+            fcntl.ioctl(self._fd, CEC_ADAP_G_PHYS_ADDR, buffer)
+            self.physical_address = struct.unpack("=H", buffer)[0]
+        except OSError:
+            os.close(self._fd)
+            raise
+        self._abort = threading.Event()
+        # Latest <Active Source> seen, for scan(): (physical address, monotonic time)
+        self._active_source = (None, 0.0)
+        self._active_source_changed = threading.Condition()
+        self._is_active_source = False  # we last announced ourselves and nothing's switched away since
+        self._closed = False
+        threading.Thread(target=self._read_loop, daemon=True).start()
+        logger.info(f"Using kernel CEC adapter {device} as logical address {self.logical_address:X}")
+
+    def power_status(self, address, timeout):
+        reply = self._request(self._logical_address(address), OPCODE_GIVE_DEVICE_POWER_STATUS,
+                              OPCODE_REPORT_POWER_STATUS, timeout)
+        if not reply:
+            return None
+        return POWER_STATUS_NAMES.get(reply[0], f"unknown ({reply[0]:#04x})")
+
+    def power_on(self, address, timeout):
+        self.transmit(self._logical_address(address), OPCODE_IMAGE_VIEW_ON, timeout=timeout)
+
+    def standby(self, address, timeout):
+        self.transmit(self._logical_address(address), OPCODE_STANDBY, timeout=timeout)
+
+    def transmit(self, destination, opcode, params=b"", timeout=10):
+        sent = self._transmit(destination, bytes([opcode]) + bytes(params), timeout=timeout)[0]
+        if opcode == OPCODE_ACTIVE_SOURCE and len(params) >= 2:
+            self._is_active_source = struct.unpack(">H", bytes(params[:2]))[0] == self.physical_address
+        return sent
+
+    def scan(self, timeout):
+        """Poll every logical address, then ask each one that acks for its physical
+        address, OSD name, vendor and power status -- what `cec-client scan` does."""
+        self._abort.clear()
+        deadline = time.monotonic() + timeout
+        devices = []
+        for number in range(BROADCAST):
+            if self._abort.is_set() or time.monotonic() >= deadline:
+                logger.info("Abandoned in-progress CEC bus scan")
+                return ScanResult([])
+            if number == self.logical_address:
+                continue
+            acked, _ = self._transmit(number, b"", timeout=1)
+            if acked:
+                devices.append(self._describe(number))
+
+        requested_at = time.monotonic()
+        self.request_active_source()
+        with self._active_source_changed:
+            self._active_source_changed.wait_for(lambda: self._active_source[1] >= requested_at,
+                                                 self.ACTIVE_SOURCE_WAIT)
+            active_address = self._active_source[0] if self._active_source[1] >= requested_at else None
+        active = next((d for d in devices if active_address and d.address == active_address), None)
+        if active is not None:
+            active.active_source = True
+            active_source_text = f"{active.type_name} ({active.number})"
+        else:
+            active_source_text = "unknown (-1)"
+        return ScanResult(devices, active_source_text)
+
+    def abort(self):
+        self._abort.set()
+
+    def close(self):
+        self._closed = True
+        os.close(self._fd)
+
+    def _describe(self, number):
+        device = CecDevice(str(number), LOGICAL_ADDRESS_NAMES[number])
+        reply = self._request(number, OPCODE_GIVE_PHYSICAL_ADDRESS, OPCODE_REPORT_PHYSICAL_ADDRESS)
+        if reply and len(reply) >= 2:
+            device.address = decode_physical_address(reply)
+        reply = self._request(number, OPCODE_GIVE_OSD_NAME, OPCODE_SET_OSD_NAME)
+        if reply:
+            device.osd_name = reply.decode('ascii', 'replace')
+        reply = self._request(number, OPCODE_GIVE_DEVICE_VENDOR_ID, OPCODE_DEVICE_VENDOR_ID)
+        if reply and len(reply) >= 3:
+            device.vendor = reply[:3].hex()
+        reply = self._request(number, OPCODE_GIVE_DEVICE_POWER_STATUS, OPCODE_REPORT_POWER_STATUS)
+        if reply:
+            device.power_status = POWER_STATUS_NAMES.get(reply[0])
+        return device
+
+    def _request(self, destination, opcode, reply_opcode, timeout=1):
+        """Send `opcode` and return the operands of the `reply_opcode` answer, or None."""
+        _, reply = self._transmit(destination, bytes([opcode]), reply_opcode, timeout)
+        return reply
+
+    def _transmit(self, destination, data, reply_opcode=0, timeout=1):
+        """One CEC_TRANSMIT. Returns (acked, reply operands or None). With `reply_opcode`
+        the kernel holds the ioctl until that reply arrives or `timeout` runs out."""
+        message = bytes([(self.logical_address << 4) | destination]) + data
+        buffer = bytearray(CEC_MSG.pack(0, 0, len(message), int(timeout * 1000) if reply_opcode else 0, 0, 0,
+                                        message, reply_opcode, 0, 0, 0, 0, 0, 0))
+        try:
+            fcntl.ioctl(self._fd, CEC_TRANSMIT, buffer)
+        except OSError as e:
+            logger.warning(f"CEC transmit of {message.hex(':')} failed: {e}")
+            return False, None
+        fields = CEC_MSG.unpack(buffer)
+        length, payload, rx_status, tx_status = fields[2], fields[6], fields[8], fields[9]
+        acked = bool(tx_status & CEC_TX_STATUS_OK)
+        if not reply_opcode or rx_status & CEC_RX_STATUS_FEATURE_ABORT or not rx_status & CEC_RX_STATUS_OK:
+            return acked, None
+        frame = self._frame(payload[:length])
+        self._notify(frame)  # replies go to us, not to followers; pass them on like cec-client's traffic log
+        return acked, frame.params
+
+    def _claim_logical_address(self):
+        """Our logical address, configuring the adapter as a playback device first if
+        nothing (e.g. cec-ctl at boot) has given it one yet."""
+        buffer = bytearray(CEC_LOG_ADDRS.size)
+        fcntl.ioctl(self._fd, CEC_ADAP_G_LOG_ADDRS, buffer)
+        fields = CEC_LOG_ADDRS.unpack(buffer)
+        if fields[3] and fields[0][0] != CEC_LOG_ADDR_INVALID:
+            return fields[0][0]
+
+        buffer = bytearray(CEC_LOG_ADDRS.pack(
+            b"", 0, CEC_OP_CEC_VERSION_1_4, 1, CEC_VENDOR_ID_NONE, 0, self.OSD_NAME.encode('ascii'),
+            bytes([CEC_OP_PRIM_DEVTYPE_PLAYBACK]), bytes([CEC_LOG_ADDR_TYPE_PLAYBACK]),
+            bytes([CEC_OP_ALL_DEVTYPE_PLAYBACK]), b""
+        ))
+        fcntl.ioctl(self._fd, CEC_ADAP_S_LOG_ADDRS, buffer)  # blocks until the address is claimed
+        logical_address = CEC_LOG_ADDRS.unpack(buffer)[0][0]
+        if logical_address == CEC_LOG_ADDR_INVALID:
+            raise OSError(errno.ENONET, f"couldn't claim a logical address on {self.device}")
+        return logical_address
+
+    def _logical_address(self, address):
+        """TV passes its own address as either a logical one ("0") or its physical one
+        ("0.0.0.0", which is always the TV itself)."""
+        if '.' not in str(address):
+            return int(str(address), 16)
+        if address.strip('0.') == "":
+            return 0
+        raise ValueError(f"can't address {address} directly on the kernel CEC backend; use its logical address")
+
+    def _frame(self, message):
+        return CecFrame(message[0] >> 4, message[0] & 0x0F, message[1] if len(message) > 1 else None,
+                        bytes(message[2:]), False)
+
+    def _read_loop(self):
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN | select.POLLPRI)
+        while not self._closed:
+            try:
+                events = poller.poll(1000)
+            except OSError:
+                break
+            for _, mask in events:
+                if mask & select.POLLPRI:
+                    self._dequeue_event()
+                if mask & select.POLLIN:
+                    self._receive()
+                if mask & (select.POLLERR | select.POLLHUP | select.POLLNVAL):
+                    if not self._closed:
+                        logger.error(f"Kernel CEC device {self.device} went away")
+                    return
+
+    def _receive(self):
+        buffer = bytearray(CEC_MSG.size)
+        try:
+            fcntl.ioctl(self._fd, CEC_RECEIVE, buffer)
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                logger.warning(f"CEC receive failed: {e}")
+            return
+        fields = CEC_MSG.unpack(buffer)
+        frame = self._frame(fields[6][:fields[2]])
+        if frame.opcode == OPCODE_ACTIVE_SOURCE:
+            with self._active_source_changed:
+                self._active_source = (frame.physical_address(), time.monotonic())
+                self._active_source_changed.notify_all()
+        self._answer(frame)
+        self._notify(frame)
+
+    def _answer(self, frame):
+        """Reply to what cec-client answered for us as a playback device, and keep track
+        of whether we're still the active source (the TV or another device switching
+        away means we aren't)."""
+        if frame.initiator == self.logical_address:
+            return
+        ours = struct.pack(">H", self.physical_address)
+        route = bytes(frame.params[2:4]) if frame.opcode == OPCODE_ROUTING_CHANGE else bytes(frame.params[:2])
+        if frame.opcode in (OPCODE_ACTIVE_SOURCE, OPCODE_ROUTING_CHANGE, OPCODE_SET_STREAM_PATH) and route != ours:
+            self._is_active_source = False
+        directed = frame.destination == self.logical_address
+        if frame.opcode == OPCODE_GIVE_OSD_NAME and directed:
+            self.transmit(frame.initiator, OPCODE_SET_OSD_NAME, self.OSD_NAME.encode('ascii'), timeout=1)
+        elif frame.opcode == OPCODE_GIVE_DEVICE_POWER_STATUS and directed:
+            self.transmit(frame.initiator, OPCODE_REPORT_POWER_STATUS, bytes([CEC_OP_POWER_STATUS_ON]), timeout=1)
+        elif frame.opcode == OPCODE_GIVE_PHYSICAL_ADDRESS and directed:
+            # Usually answered by the kernel itself; if it's reached us, it hasn't been
+            self.transmit(BROADCAST, OPCODE_REPORT_PHYSICAL_ADDRESS, ours + bytes([CEC_OP_PRIM_DEVTYPE_PLAYBACK]), timeout=1)
+        elif frame.opcode == OPCODE_REQUEST_ACTIVE_SOURCE and self._is_active_source:
+            self.transmit(BROADCAST, OPCODE_ACTIVE_SOURCE, ours, timeout=1)
+        elif frame.opcode == OPCODE_SET_STREAM_PATH and route == ours:
+            # The TV selected our input (e.g. from its source menu)
+            self.transmit(BROADCAST, OPCODE_ACTIVE_SOURCE, ours, timeout=1)
+
+    def _dequeue_event(self):
+        buffer = bytearray(CEC_EVENT.size)
+        try:
+            fcntl.ioctl(self._fd, CEC_DQEVENT, buffer)
+        except OSError:
+            return
+        _, event, _, phys_addr, log_addr_mask, _ = CEC_EVENT.unpack(buffer)
+        if event == CEC_EVENT_STATE_CHANGE:
+            address = decode_physical_address(struct.pack(">H", phys_addr))
+            logger.info(f"Kernel CEC adapter state changed: physical address {address}, logical mask {log_addr_mask:#06x}")
+            self.physical_address = phys_addr
+            if log_addr_mask:
+                self.logical_address = (log_addr_mask & -log_addr_mask).bit_length() - 1
+        elif event == CEC_EVENT_LOST_MSGS:
+            logger.warning("Kernel CEC receive queue overflowed; some bus traffic was lost")
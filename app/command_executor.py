@@ -0,0 +1,128 @@
+import collections
+import logging
+import threading
+import time
+from .worker_pool import WorkerPool
+
+logger = logging.getLogger(__name__)
+
+SERIALIZE = "serialize"  # run every command, one at a time, in arrival order
+LATEST = "latest"        # one at a time; a newer command replaces any still waiting
+DROP = "drop"            # one at a time; a command arriving while one runs is dropped
+PARALLEL = "parallel"    # run every command as soon as a worker is free
+POLICIES = (SERIALIZE, LATEST, DROP, PARALLEL)
+
+class _Lane:
+    """One entity's pending commands and counters."""
+
+    __slots__ = ('busy', 'pending', 'settle', 'last_arrival', 'received', 'completed', 'dropped', 'superseded',
+                 'max_depth', 'wait_total', 'wait_max', 'run_total', 'run_max')
+
+    def __init__(self):
+        self.busy = False
+        self.pending = collections.deque()  # (enqueued monotonic time, fn, args)
+        self.settle = 0
+        self.last_arrival = 0.0  # monotonic time the newest command arrived
+        self.received = self.completed = self.dropped = self.superseded = self.max_depth = 0
+        self.wait_total = self.wait_max = self.run_total = self.run_max = 0.0
+
+class CommandExecutor:
+    """Runs inbound commands (HA button presses, switch flips, select choices, slider
+    values) on a bounded worker pool instead of the MQTT network thread, with a
+    concurrency policy per entity (see POLICIES). A lane for one entity only ever
+    occupies one worker at a time unless it's PARALLEL."""
+
+    def __init__(self, max_workers=4):
+        self._pool = WorkerPool(max_workers, "mqtt-command")
+        self._lanes = {}  # key (e.g. unique_id) -> _Lane
+        self._lock = threading.Lock()
+        self._closed = False
+
+    def submit(self, key, policy, fn, *args, settle=0):
+        """Queue `fn(*args)` on `key`'s lane under `policy`. Returns False if it was dropped.
+        With LATEST, a command only runs once `settle` seconds have passed without a newer
+        one arriving (e.g. the next step of a slider drag), which replaces it instead."""
+        item = (time.monotonic(), fn, args)
+        with self._lock:
+            if self._closed:
+                return False
+            lane = self._lanes.setdefault(key, _Lane())
+            lane.received += 1
+            lane.last_arrival = item[0]
+            lane.settle = settle if policy == LATEST else 0
+            if policy == PARALLEL:
+                self._pool.submit(self._run, lane, item, key)
+                return True
+            if lane.busy:
+                if policy == DROP:
+                    lane.dropped += 1
+                    logger.debug(f"Dropped command for {key}; the previous one is still running")
+                    return False
+                if policy == LATEST:
+                    lane.superseded += len(lane.pending)
+                    lane.pending.clear()
+                lane.pending.append(item)
+                lane.max_depth = max(lane.max_depth, len(lane.pending))
+                return True
+            lane.busy = True
+        self._pool.submit(self._drain, key, lane, item)
+        return True
+
+    def _drain(self, key, lane, item):
+        while item:
+            while lane.settle:
+                # Debounce: every newer command restarts the wait, and replaces this one
+                with self._lock:
+                    quiet = time.monotonic() - lane.last_arrival
+                    if quiet >= lane.settle:
+                        if lane.pending:
+                            lane.superseded += 1
+                            item = lane.pending.popleft()
+                        break
+                time.sleep(lane.settle - quiet)
+            self._run(lane, item, key)
+            with self._lock:
+                item = lane.pending.popleft() if lane.pending else None
+                if not item:
+                    lane.busy = False
+
+    def _run(self, lane, item, key):
+        enqueued_at, fn, args = item
+        started = time.monotonic()
+        try:
+            fn(*args)
+        except Exception:
+            logger.exception(f"Command for {key} failed")
+        finished = time.monotonic()
+        with self._lock:
+            lane.completed += 1
+            wait, run = started - enqueued_at, finished - started
+            lane.wait_total += wait
+            lane.wait_max = max(lane.wait_max, wait)
+            lane.run_total += run
+            lane.run_max = max(lane.run_max, run)
+
+    def stats(self):
+        """Per key: commands received/completed/dropped/superseded, the deepest its queue
+        got, and average/max seconds spent waiting and running."""
+        with self._lock:
+            return {key: {
+                'received': lane.received,
+                'completed': lane.completed,
+                'dropped': lane.dropped,
+                'superseded': lane.superseded,
+                'max_depth': lane.max_depth,
+                'wait_avg': lane.wait_total / lane.completed if lane.completed else 0.0,
+                'wait_max': lane.wait_max,
+                'run_avg': lane.run_total / lane.completed if lane.completed else 0.0,
+                'run_max': lane.run_max,
+            } for key, lane in self._lanes.items()}
+
+    def shutdown(self):
+        """Stop taking commands and drop any not yet started. Running ones are left to
+        finish (or not) on the pool's daemon threads."""
+        with self._lock:
+            self._closed = True
+            for lane in self._lanes.values():
+                lane.pending.clear()
+        self._pool.shutdown(cancel_pending=True)
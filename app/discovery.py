@@ -0,0 +1,71 @@
+"""Home Assistant's device-based MQTT discovery: one retained config per device, listing
+all of its entities ("components"), instead of one config per entity. Keys are sent in
+HA's abbreviated form and topics relative to a shared `~` base, to keep the one payload
+small. See https://www.home-assistant.io/integrations/mqtt/#device-discovery-payload"""
+
+# HA's abbreviations for every key ha-mqtt-discoverable's entity configs can contain;
+# anything not listed here is sent as-is
+ABBREVIATIONS = {
+    'availability_topic': 'avty_t',
+    'command_topic': 'cmd_t',
+    'component': 'p',
+    'device_class': 'dev_cla',
+    'enabled_by_default': 'en',
+    'entity_category': 'ent_cat',
+    'expire_after': 'exp_aft',
+    'force_update': 'frc_upd',
+    'icon': 'ic',
+    'json_attributes_topic': 'json_attr_t',
+    'object_id': 'obj_id',
+    'optimistic': 'opt',
+    'options': 'ops',
+    'payload_off': 'pl_off',
+    'payload_on': 'pl_on',
+    'payload_press': 'pl_prs',
+    'retain': 'ret',
+    'state_class': 'stat_cla',
+    'state_off': 'stat_off',
+    'state_on': 'stat_on',
+    'state_topic': 'stat_t',
+    'unique_id': 'uniq_id',
+    'unit_of_measurement': 'unit_of_meas',
+}
+DEVICE_ABBREVIATIONS = {
+    'configuration_url': 'cu',
+    'connections': 'cns',
+    'hw_version': 'hw',
+    'identifiers': 'ids',
+    'manufacturer': 'mf',
+    'model': 'mdl',
+    'name': 'name',
+    'suggested_area': 'sa',
+    'sw_version': 'sw',
+    'via_device': 'via_device',
+}
+TOPIC_KEYS = ('availability_topic', 'command_topic', 'json_attributes_topic', 'state_topic')
+
+def _relative(topic, base):
+    return "~" + topic[len(base):] if topic.startswith(base + "/") else topic
+
+def device_payload(entity_configs, base_topic, availability_topic, origin):
+    """Build the device discovery payload from ha-mqtt-discoverable entity configs
+    (generate_config() output, all for the same device). Each becomes a component keyed
+    by its unique_id; the device itself and the shared availability topic are stated
+    once at the top level instead of in every component."""
+    device = {}
+    components = {}
+    for config in entity_configs:
+        config = dict(config)
+        device = config.pop('device', device)
+        config.pop('availability_topic', None)
+        for key in TOPIC_KEYS:
+            if key in config:
+                config[key] = _relative(config[key], base_topic)
+        components[config['unique_id']] = {ABBREVIATIONS.get(key, key): value for key, value in config.items()}
+    return {
+        '~': base_topic,
+        'dev': {DEVICE_ABBREVIATIONS.get(key, key): value for key, value in device.items()},
+        'o': origin,
+        'avty_t': _relative(availability_topic, base_topic),
+        'cmps': components,
+    }
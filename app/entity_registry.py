@@ -0,0 +1,133 @@
+import logging
+import threading
+from .command_executor import POLICIES
+
+logger = logging.getLogger(__name__)
+
+# How each kind of entity's commands run unless entities.yaml sets `concurrency:` (see
+# app/command_executor.py): slider drags and repeated selections settle on the latest
+DEFAULT_CONCURRENCY = {'button': "serialize", 'switch': "latest", 'select': "latest", 'number': "latest"}
+DEFAULT_SETTLE = {'number': 0.2}  # seconds a "latest" command waits for a newer one; entities.yaml `settle:`
+# What an attribute's `depends_on:` can list: HomeAssistantClient.invalidate() events, plus
+# "interval" (re-read with the entity's `interval:`, or the attribute's own)
+ATTRIBUTE_EVENTS = ("app_change", "tv_state", "interval")
+DEFAULT_DEPENDS_ON = ("interval",)
+
+class EntityRecord:
+    """Everything HomeAssistantClient needs about one entities.yaml entity, resolved once
+    at setup: the ha-mqtt-discoverable entity, bound methods instead of dotted paths, and
+    (for "{{apps}}"/"{{apps_all}}" selects) the canonical<->display option maps."""
+
+    __slots__ = ('unique_id', 'component', 'entity', 'state_getter', 'callbacks',
+                 'attribute_getters', 'attribute_depends', 'attribute_values', 'to_display', 'to_canonical',
+                 'command_topic', 'on_command', 'concurrency', 'settle', '_lock')
+
+    def __init__(self, unique_id, component, entity=None, state_getter=None, callbacks=None,
+                 attribute_getters=None, to_display=None, to_canonical=None):
+        self.unique_id = unique_id
+        self.component = component
+        self.entity = entity
+        self.state_getter = state_getter
+        self.callbacks = callbacks or {}  # e.g. {'press': ...} or {'on': ..., 'off': ...}
+        self.attribute_getters = attribute_getters or {}  # attribute name -> getter
+        self.attribute_depends = {}  # attribute name -> set of ATTRIBUTE_EVENTS it's re-read on
+        self.attribute_values = {}  # attribute name -> last value its getter returned
+        # Guards attribute_values: refreshes come from the scheduler, invalidate() callers
+        # and the initial-state readers at once
+        self._lock = threading.Lock()
+        self.to_display = to_display or {}
+        self.to_canonical = to_canonical or {}
+        self.command_topic = None
+        self.on_command = None  # MQTT message handler for command_topic
+        self.concurrency = DEFAULT_CONCURRENCY.get(component)
+        self.settle = DEFAULT_SETTLE.get(component, 0)
+
+    def display_value(self, canonical_value):
+        return self.to_display.get(canonical_value, canonical_value)
+
+    def canonical_value(self, display_value):
+        return self.to_canonical.get(display_value, display_value)
+
+    def attributes(self, names=None):
+        """Call the attribute getters in `names` (default: all of them) and return every
+        attribute's latest value, e.g. {"uptime": "2h 14m"}. A getter that fails or
+        returns None is omitted. Getters run outside the lock; only the update is under it."""
+        values = {}
+        for name in self.attribute_getters if names is None else names:
+            try:
+                values[name] = self.attribute_getters[name]()
+            except Exception as e:
+                logger.error(f"Error getting attribute '{name}' of {self.unique_id}: {e}")
+                values[name] = None
+        with self._lock:
+            for name, value in values.items():
+                if value is None:
+                    self.attribute_values.pop(name, None)
+                else:
+                    self.attribute_values[name] = value
+            return dict(self.attribute_values)
+
+    def attributes_depending_on(self, event):
+        return [name for name, events in self.attribute_depends.items() if event in events]
+
+class EntityRegistry:
+    """Every set-up entity, indexed by unique_id and by command topic, plus the dotted
+    path resolution used to build them. Paths are resolved against `root` (the
+    HomeAssistantClient, which holds tv/displays/supervisor/utils) once, so a typo in
+    entities.yaml is reported while loading rather than at the first button press."""
+
+    def __init__(self, root):
+        self.root = root
+        self.by_unique_id = {}
+        self.by_command_topic = {}
+        self.problems = []  # "<unique_id>: <what went wrong>", for everything reported so far
+
+    def resolve(self, unique_id, dotted_path, role):
+        """The bound method `dotted_path` (e.g. "utils.get_ip_address") names, or None
+        (after logging why) if it doesn't name one. `role` says what it's for, e.g.
+        "state" or "callback", for the error message."""
+        obj = self.root
+        try:
+            for part in dotted_path.split('.'):
+                obj = getattr(obj, part)
+        except AttributeError as e:
+            return self._problem(unique_id, f"{role} '{dotted_path}' can't be resolved: {e}")
+        if not callable(obj):
+            return self._problem(unique_id, f"{role} '{dotted_path}' is not callable")
+        return obj
+
+    def concurrency(self, unique_id, component, entity_config):
+        """An entities.yaml entry's `concurrency:` policy, or its kind's default if it
+        has none or an unknown one (which is reported)."""
+        policy = entity_config.get('concurrency', DEFAULT_CONCURRENCY.get(component))
+        if policy not in POLICIES:
+            self._problem(unique_id, f"concurrency '{policy}' isn't one of {', '.join(POLICIES)}")
+            return DEFAULT_CONCURRENCY.get(component)
+        return policy
+
+    def depends_on(self, unique_id, name, attribute_config):
+        """The events an attribute's `depends_on:` lists (DEFAULT_DEPENDS_ON if none),
+        leaving out (and reporting) any that aren't ATTRIBUTE_EVENTS."""
+        events = set(attribute_config.get('depends_on', DEFAULT_DEPENDS_ON))
+        for event in events - set(ATTRIBUTE_EVENTS):
+            self._problem(unique_id, f"attribute '{name}' depends_on '{event}' isn't one of {', '.join(ATTRIBUTE_EVENTS)}")
+        return events & set(ATTRIBUTE_EVENTS)
+
+    def _problem(self, unique_id, message):
+        logger.error(f"Entity {unique_id}: {message}")
+        self.problems.append(f"{unique_id}: {message}")
+        return None
+
+    def add(self, record):
+        if record.unique_id in self.by_unique_id:
+            logger.warning(f"Duplicate entity unique_id {record.unique_id}; the later one replaces the earlier")
+        self.by_unique_id[record.unique_id] = record
+        if record.command_topic:
+            self.by_command_topic[record.command_topic] = record
+        return record
+
+    def get(self, unique_id):
+        return self.by_unique_id.get(unique_id)
+
+    def __iter__(self):
+        return iter(self.by_unique_id.values())
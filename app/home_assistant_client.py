@@ -1,126 +1,576 @@
-import concurrent.futures
 import paho.mqtt.client as mqtt
+import concurrent.futures
+import functools
+import hashlib
+import json
+import threading
 import time
 import logging
-from ha_mqtt_discoverable import Settings, DeviceInfo
+from types import SimpleNamespace
+from ha_mqtt_discoverable import Discoverable, Settings, DeviceInfo
+from ha_mqtt_discoverable.utils import clean_string
 from ha_mqtt_discoverable.sensors import BinarySensor, BinarySensorInfo, Button, ButtonInfo, Switch, SwitchInfo, Sensor, SensorInfo, Select, SelectInfo, Number, NumberInfo
+from .command_executor import CommandExecutor
+from .discovery import device_payload
+from .entity_registry import EntityRecord, EntityRegistry
+from .mqtt5 import SESSION_EXPIRY, TopicAliases, connect_properties
+from .publish_queue import PublishQueue
+from .refresh_scheduler import RefreshScheduler
+from .worker_pool import WorkerPool
 from .supervisor import NONE_APP_OPTION, NO_APP_RUNNING
 
 logger = logging.getLogger(__name__)
 
 APPS_ALL_OPTIONS = "{{apps_all}}"  # entities.yaml select `options:` shorthand — see _apps_all_options()
 APPS_OPTIONS = "{{apps}}"  # entities.yaml select `options:` shorthand — see _apps_options()
+DEFAULT_QOS = {'sensor': 0, 'binary_sensor': 0, 'switch': 1, 'select': 1, 'number': 1}  # by entity class; see config.yaml `qos:`
+DISCOVERY_PREFIX = "homeassistant"  # ha-mqtt-discoverable's default; config topics live under it
+HA_STATUS_TOPIC = f"{DISCOVERY_PREFIX}/status"  # HA's birth/last-will topic ("online"/"offline")
+INITIAL_STATE_TIMEOUT = 3  # seconds setup_discovery waits for state getters; later ones are published on arrival
+INITIAL_STATE_WORKERS = 8  # threads reading entities' initial state at setup
+RESTORE_TIMEOUT = 2  # seconds setup_discovery waits for the broker's retained state at startup
+RESTORE_QUIET = 0.3  # seconds without another retained message before they're taken to be all in
+STATE_PREFIX = "hmd"  # ha-mqtt-discoverable's default prefix for state/command/availability topics
 
 class HomeAssistantClient:
-    def __init__(self, broker, port, username, password, config, entities, supervisor, tv, utils):
-        self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
+    def __init__(self, broker, port, username, password, config, entities, supervisor, tv, utils, displays=None, discovery_store=None):
+        # MQTT v5 (opt in with `mqtt_version: 5`): state by topic alias and with a message
+        # expiry, and a session the broker keeps across short drops (see app/mqtt5.py).
+        # Resuming a session needs the same client id every time.
+        self.v5 = config.get('mqtt_version', 3) == 5
+        if self.v5:
+            self.client = mqtt.Client(client_id=f"{STATE_PREFIX}-{clean_string(config['name'])}", protocol=mqtt.MQTTv5,
+                                      callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
+        else:
+            self.client = mqtt.Client(callback_api_version=mqtt.CallbackAPIVersion.VERSION1)
         self.client.username_pw_set(username, password)
         self.client.on_connect = self.on_connect
         self.client.on_disconnect = self.on_disconnect
         self.client.on_message = self.on_message
-        self.retained_values = {}
-        # unique_id -> {'to_canonical': {display: canonical}, 'to_display': {canonical: display}},
-        # only populated for selects using the "{{apps_all}}" options shorthand
-        self._select_maps = {}
-        self._sensor_attribute_specs = {}  # unique_id -> {attribute_name: dotted_path}, from entities.yaml
+        # Full state/attributes topic -> payload retained on the broker from the last run,
+        # gathered by restore_retained_state
+        self._retained_states = {}
+        self._restoring = False
+        self._last_restored_at = 0
+        self._connected = threading.Event()
+        # Every entity shares this one availability topic, so a single last will (set
+        # before connecting) takes them all offline if the connection drops uncleanly.
+        device_topic = self._device_topic = clean_string(config['name'])
+        self.availability_topic = f"{STATE_PREFIX}/{device_topic}/availability"
+        device_id = config['name'].lower().replace(' ', '_')
+        self.device_config_topic = f"{DISCOVERY_PREFIX}/device/{clean_string(device_id)}/config"
+        self.client.will_set(self.availability_topic, "offline", retain=True)
+        # All command entities (buttons, switches, selects, numbers) receive on this one
+        # connection: one wildcard subscription, routed by exact topic in on_message
+        self._command_subscription = f"{STATE_PREFIX}/+/{device_topic}/+/command"
+        # Our own retained discovery configs, so a HA restart only re-announces any the
+        # broker no longer has (see resync_home_assistant)
+        self._config_subscription = f"{DISCOVERY_PREFIX}/+/{device_topic}/+/config"
+        # Commands run on a small worker pool, so a slow one never stalls the network
+        # loop (keepalives, other entities' commands) behind it; each entity's
+        # `concurrency:` policy decides what happens to commands that arrive meanwhile
+        self.command_executor = CommandExecutor(config.get('command_workers', 4))
+        # topic -> (payload, time.monotonic() it was last sent), so _publish can drop a
+        # state or attributes payload identical to the one already retained on the broker
+        self._last_published = {}
+        self._publish_lock = threading.Lock()
+        self.publish_counts = {'sent': 0, 'suppressed': 0}
+        # Even an unchanged payload is re-sent once it's this old (seconds), so HA's
+        # expire_after never lapses on a value that simply hasn't changed. Defaults to
+        # half of expire_after; without either, unchanged payloads are never re-sent.
+        expire_after = config.get('expire_after')
+        self.state_refresh_interval = config.get('state_refresh_interval', expire_after / 2 if expire_after else None)
+        # The per-entity availability topics the library would have used (and earlier
+        # versions did), still retained on the broker until _clear_legacy_availability
+        self._legacy_availability_topics = []
+        # Content hashes of the discovery configs the broker already holds (config topic ->
+        # sha256), persisted across restarts so unchanged entities aren't re-announced
+        self.discovery_store = discovery_store
+        self._config_hashes = dict(discovery_store.get('configs', {})) if discovery_store else {}
+        self._configured = set()  # config topics published (or confirmed unchanged) this run
+        self._retained_configs = {}  # config topic -> sha256 of the config the broker holds
+        self._retained_config_ids = {}  # config topic -> unique_id in the config the broker holds
+        # unique_id -> the config topic it was first announced on. Topics are derived from
+        # entity names, so keeping an entity on its first one means renaming it in
+        # entities.yaml updates it in HA rather than replacing it with a new entity.
+        self._config_topics = dict(discovery_store.get('config_topics', {})) if discovery_store else {}
+        self._discovery_entities = {}  # entity config topic -> entity, in setup order
+        # "entity": one discovery config per entity (the library's way). "device": a single
+        # consolidated config for the whole device, written once setup_discovery finishes.
+        self.discovery_mode = config.get('discovery_mode', 'entity')
+        self._discovery_ready = False
+        # State leaves through one writer thread, newest value per topic, so callers on
+        # hot paths (TV, volume watcher, app switching) never wait on MQTT I/O
+        self.topic_aliases = TopicAliases(config.get('topic_alias_maximum', 10)) if self.v5 else None
+        self.publish_queue = PublishQueue(self.client, config.get('publish_coalesce_window', PublishQueue.COALESCE_WINDOW),
+                                          v5=self.v5, aliases=self.topic_aliases)
+        self.qos = {**DEFAULT_QOS, **config.get('qos', {})}
+        # v5 only: seconds the broker keeps a state publish, by entity class. Sensors default
+        # to expire_after, past which HA would ignore the value anyway.
+        default_expiry = {'sensor': expire_after, 'binary_sensor': expire_after} if expire_after else {}
+        self.message_expiry = {**default_expiry, **config.get('message_expiry', {})}
 
         # Connect asynchronously so a down/absent network never blocks or raises here;
         # the network loop thread keeps retrying with backoff until the broker is reachable.
         self.client.reconnect_delay_set(min_delay=1, max_delay=120)
-        self.client.connect_async(broker, port, 60)
+        if self.v5:
+            self.client.connect_async(broker, port, 60, clean_start=False,
+                                      properties=connect_properties(config.get('session_expiry', SESSION_EXPIRY)))
+        else:
+            self.client.connect_async(broker, port, 60)
         self.client.loop_start()
 
         self.config = config
         self.entities = entities
         self.supervisor = supervisor
         self.tv = tv
+        # Every display by id, so entities can target one as "displays.<id>.<method>"
+        # ("tv." is the first display)
+        self.displays = SimpleNamespace(**(displays or {}))
         self.utils = utils
-        self._shared_entities = []  # entities on the shared client; re-announced on reconnect
+        # Every set-up entity by unique_id and command topic, with its dotted paths
+        # from entities.yaml already resolved (see setup_discovery)
+        self.registry = EntityRegistry(self)
+        self._attribute_watchers = {}  # invalidate() event -> [EntityRecord with attributes depending on it]
+        # Re-reads sensors with an entities.yaml `interval:`, all on one thread
+        self.refresh_scheduler = RefreshScheduler(before_batch=getattr(utils, 'begin_refresh_batch', None))
         logger.info("HomeAssistantClient initialized, connecting to MQTT broker in the background")
 
         self.device_info = DeviceInfo(
             name=config['name'],
-            identifiers=[config['name'].lower().replace(' ', '_')],
+            identifiers=[device_id],
             model=self.utils.model,
             manufacturer=self.utils.manufacturer,
             sw_version=self.utils.sw_version,
             hw_version=self.utils.hw_version,
             configuration_url=config.get('configuration_url', None)
         )
-        # Button/Switch/Select each open and connect their own MQTT client internally
-        # (the library's Subscriber base class requires this), so they use their own settings.
+        # Every entity publishes through the already-connecting shared client
         self.mqtt_settings = Settings.MQTT(
-            host=broker,
-            username=username,
-            password=password,
-            port=port
-        )
-        # BinarySensor/Sensor don't manage their own connection, so it's safe (and cheaper)
-        # for them to reuse the already-connecting shared client instead of opening a new one.
-        self.shared_mqtt_settings = Settings.MQTT(
             host=broker,
             username=username,
             password=password,
             port=port,
+            state_prefix=STATE_PREFIX,
             client=self.client
         )
 
-    def _rebroadcast_availability_on_reconnect(self, entity):
-        """Button/Switch/Select each own a separate MQTT client (see the comment in
-        __init__), so the shared client's on_connect handler above never fires for them.
-        Wrap their client's on_connect so a dropped-and-restored connection re-announces
-        "online" too, without disturbing the library's own on_connect (command re-subscribe)."""
-        original_on_connect = entity.mqtt_client.on_connect
-        def on_connect(client, userdata, *args):
-            if original_on_connect:
-                original_on_connect(client, userdata, *args)
-            entity.set_availability(True)
-        entity.mqtt_client.on_connect = on_connect
-
-    def _resolve_dotted(self, dotted_path):
-        """Resolve a dotted path like "utils.get_ip_address" against self (which holds
-        tv/supervisor/utils), returning the bound method."""
-        parts = dotted_path.split('.')
-        obj = self
-        for part in parts[:-1]:
-            obj = getattr(obj, part)
-        return getattr(obj, parts[-1])
-
-    def _resolve_attributes(self, attribute_specs):
-        """Resolve entities.yaml's `attributes: {name: dotted.path}` into a plain dict,
-        e.g. {"uptime": "2h 14m"}. A path that fails or resolves to None is omitted."""
-        resolved = {}
-        for name, dotted_path in attribute_specs.items():
-            try:
-                value = self._resolve_dotted(dotted_path)()
-            except AttributeError as e:
-                logger.error(f"Error resolving attribute '{name}' ({dotted_path}): {e}")
+    def _publish(self, entity, topic, payload, force=False):
+        """The one way state and attributes leave this client: queue `payload` (retained,
+        at `entity`'s class QoS) for `topic`, unless it's what was last sent there and that
+        was recent enough (see state_refresh_interval). `force` sends it regardless."""
+        now = time.monotonic()
+        with self._publish_lock:
+            last = self._last_published.get(topic)
+            if not force and last is not None and last[0] == payload and (
+                    self.state_refresh_interval is None or now - last[1] < self.state_refresh_interval):
+                self.publish_counts['suppressed'] += 1
+                return False
+            self._last_published[topic] = (payload, now)
+            self.publish_counts['sent'] += 1
+        logger.debug(f"Publishing '{payload}' to {topic}")
+        component = entity._entity.component
+        self.publish_queue.put(topic, payload, qos=self.qos.get(component, 0), expiry=self.message_expiry.get(component))
+        return True
+
+    def _write_config(self, entity, force=False):
+        """Publish `entity`'s discovery config (or, in "device" discovery mode, the device
+        config it's part of), unless unchanged -- see _publish_config. Stands in for the
+        library's write_config()."""
+        entity.wrote_configuration = True
+        self._discovery_entities[entity.config_topic] = entity
+        if self.discovery_mode == 'device':
+            # Until setup_discovery has every entity, there's no complete device config yet
+            return self._write_device_config(force) if self._discovery_ready else False
+        entity.config_message = json.dumps(entity.generate_config())
+        return self._publish_config(entity.config_topic, entity.config_message, force)
+
+    def _write_device_config(self, force=False):
+        """Publish every entity as one device discovery config (see app/discovery.py).
+        Entities dropped since the last run are listed with just their platform, which is
+        how HA is told to remove a component from a device."""
+        configs = [entity.generate_config() for entity in self._discovery_entities.values()]
+        payload = device_payload(configs, STATE_PREFIX, self.availability_topic,
+                                 {'name': "magic-mirror-supervisor", 'sw': self.utils.sw_version})
+        previous = self.discovery_store.get('components', {}) if self.discovery_store else {}
+        declared = self._declared_unique_ids()
+        for uid, component in previous.items():
+            if uid in payload['cmps']:
                 continue
-            if value is not None:
-                resolved[name] = value
-        return resolved
+            if uid not in declared:
+                payload['cmps'][uid] = {'p': component['p'] if isinstance(component, dict) else component}
+            elif isinstance(component, dict):
+                # Still in entities.yaml but its setup failed this run: keep it as it was
+                logger.warning(f"Keeping {uid} in the device config as last announced; it wasn't set up this run")
+                payload['cmps'][uid] = component
+        published = self._publish_config(self.device_config_topic, json.dumps(payload, separators=(',', ':')), force)
+        if self.discovery_store:
+            self.discovery_store.update({'components': {uid: component for uid, component in payload['cmps'].items()
+                                                        if len(component) > 1}})
+        return published
+
+    def _publish_config(self, config_topic, config_message, force=False):
+        """Publish a discovery config, unless the broker already has this exact config
+        retained from an earlier run (judged by its hash). `force` sends it regardless."""
+        digest = hashlib.sha256(config_message.encode()).hexdigest()
+        self._configured.add(config_topic)
+        if not force and self._config_hashes.get(config_topic) == digest:
+            logger.debug(f"Discovery config for {config_topic} unchanged; not republishing")
+            return False
+        self.client.publish(config_topic, config_message, qos=1, retain=True)
+        self._config_hashes[config_topic] = digest
+        return True
+
+    def _save_config_hashes(self):
+        if self.discovery_store:
+            self.discovery_store.update({'configs': dict(self._config_hashes), 'config_topics': dict(self._config_topics)})
+
+    def _clear_legacy_availability(self):
+        """Delete the retained per-entity availability topics from before the shared
+        one, once. That's remembered in the discovery store only after the broker has
+        acknowledged every delete, so a restart before then tries again. In the
+        background, since it waits for a connection."""
+        if not self._legacy_availability_topics or (self.discovery_store and self.discovery_store.get('legacy_availability_cleared')):
+            return
+        threading.Thread(target=self._clear_legacy_availability_when_connected, name="legacy-availability", daemon=True).start()
 
-    def refresh_sensor_attributes(self):
-        """Re-resolve and push every sensor's declared `attributes` (see entities.yaml)."""
-        for unique_id, attribute_specs in self._sensor_attribute_specs.items():
-            self.update_sensor_attributes(unique_id, self._resolve_attributes(attribute_specs))
+    def _clear_legacy_availability_when_connected(self, timeout=30):
+        self._connected.wait()
+        try:
+            for message_info in [self.client.publish(topic, "", qos=1, retain=True)
+                                 for topic in self._legacy_availability_topics]:
+                message_info.wait_for_publish(timeout)
+                if not message_info.is_published():
+                    raise RuntimeError(f"not acknowledged within {timeout}s")
+        except (RuntimeError, ValueError) as e:
+            logger.warning(f"Couldn't clear the per-entity availability topics ({e}); trying again next start")
+            return
+        logger.info(f"Cleared {len(self._legacy_availability_topics)} per-entity availability topic(s)")
+        if self.discovery_store:
+            self.discovery_store.update({'legacy_availability_cleared': True})
+
+    def _declared_unique_ids(self):
+        """Every unique_id entities.yaml declares, whether or not its setup succeeded."""
+        return {entry.get('unique_id') for entries in self.entities.values() if isinstance(entries, list)
+                for entry in entries if isinstance(entry, dict)}
+
+    def _remove_stale_configs(self, keep_declared=True):
+        """Delete (with an empty retained payload) the discovery config of every entity
+        announced by an earlier run that's no longer in entities.yaml -- HA then drops
+        the entity. One that's still declared but whose setup failed this run keeps its
+        config (and so its HA history and customizations), unless `keep_declared` is
+        False (switching to device discovery, where its unique_id moves to the device
+        config). A config we can't tie to a unique_id goes if nothing set it up."""
+        declared = self._declared_unique_ids()
+        owners = {topic: uid for uid, topic in self._config_topics.items()}
+        for config_topic in set(self._config_hashes) - self._configured:
+            unique_id = owners.get(config_topic) or self._retained_config_ids.get(config_topic)
+            if keep_declared and unique_id in declared:
+                logger.warning(f"Keeping discovery config {config_topic}: {unique_id} is in entities.yaml "
+                               f"but wasn't set up this run")
+                continue
+            logger.info(f"Removing discovery config {config_topic}; entity no longer configured")
+            self.client.publish(config_topic, "", qos=1, retain=True)
+            del self._config_hashes[config_topic]
+            if unique_id not in declared:
+                self._config_topics.pop(unique_id, None)
+
+    def _remove_device_config(self):
+        """Delete the device discovery config a "device" mode run left (switching back
+        to "entity"). It has to go before any per-entity config is sent: HA rejects
+        those while the device still owns their unique_ids."""
+        if self.device_config_topic not in self._config_hashes and self.device_config_topic not in self._retained_configs:
+            return
+        logger.info(f"Removing device discovery config {self.device_config_topic}; using per-entity configs")
+        self.client.publish(self.device_config_topic, "", qos=1, retain=True)
+        self._config_hashes.pop(self.device_config_topic, None)
+        if self.discovery_store:
+            self.discovery_store.update({'components': {}})
+
+    def _republish_missing_configs(self):
+        """Re-announce every entity whose discovery config the broker doesn't hold as
+        last published (per the retained configs seen on our config subscriptions), e.g.
+        after a broker restart lost them. Returns how many configs were sent."""
+        # A copy: HA's birth can arrive while setup_discovery is still adding to it
+        missing = [topic for topic in list(self._configured)
+                   if self._retained_configs.get(topic) != self._config_hashes.get(topic)]
+        for config_topic in missing:
+            if config_topic == self.device_config_topic:
+                self._write_device_config(force=True)
+            else:
+                self._write_config(self._discovery_entities[config_topic], force=True)
+        return len(missing)
+
+    def resync_home_assistant(self):
+        """Bring a freshly (re)started HA up to date in one burst: discovery configs it
+        might be missing, availability, and the last state sent for every entity."""
+        started = time.monotonic()
+        configs = self._republish_missing_configs()
+        if configs:
+            self._save_config_hashes()
+        self.client.publish(self.availability_topic, "online", retain=True)
+        states = self.publish_queue.republish_all()
+        self.publish_queue.flush(timeout=5)
+        logger.info(f"Resynced with Home Assistant: {configs} discovery config(s), {states} state topic(s) "
+                    f"in {(time.monotonic() - started) * 1000:.0f} ms")
+
+    def _entity(self, entity_cls, settings, record):
+        """Construct an entity on the shared client, announcing its availability on the
+        device-wide topic rather than one of its own, and register it as `record`."""
+        entity = entity_cls(settings)
+        self._legacy_availability_topics.append(entity.availability_topic)
+        entity.availability_topic = self.availability_topic
+        entity.config_topic = self._config_topics.setdefault(record.unique_id, entity.config_topic)
+        record.entity = entity
+        return self.registry.add(record)
+
+    def _command_entity(self, entity_cls, settings, record, on_command):
+        """Construct a Button/Switch/Select/Number on the shared client. The library's
+        Subscriber.__init__ would connect the client itself and replace its on_message
+        with this one entity's callback, so only the Discoverable part of it runs here;
+        the command topic is routed to `on_command` by on_message instead."""
+        entity = entity_cls.__new__(entity_cls)
+        Discoverable.__init__(entity, settings)
+        self._legacy_availability_topics.append(entity.availability_topic)
+        entity.availability_topic = self.availability_topic
+        entity.config_topic = self._config_topics.setdefault(record.unique_id, entity.config_topic)
+        entity._command_topic = f"{STATE_PREFIX}/{entity._entity_topic}/command"
+        record.entity = entity
+        record.command_topic = entity._command_topic
+        record.on_command = on_command
+        return self.registry.add(record)
+
+    def _concurrency(self, record, entity_config):
+        record.concurrency = self.registry.concurrency(record.unique_id, record.component, entity_config)
+        record.settle = entity_config.get('settle', record.settle)
+        return record
+
+    def _resolve_getters(self, unique_id, entity_config):
+        """An entities.yaml entry's `state` getter and `attributes` getters (see
+        EntityRegistry.resolve), as (state_getter, {attribute name: getter})."""
+        state_method = entity_config.get('state')
+        state_getter = self.registry.resolve(unique_id, state_method, "state") if state_method else None
+        attribute_getters = {}
+        for name, attribute in (entity_config.get('attributes') or {}).items():
+            dotted_path = attribute['value'] if isinstance(attribute, dict) else attribute
+            getter = self.registry.resolve(unique_id, dotted_path, f"attribute '{name}'")
+            if getter:
+                attribute_getters[name] = getter
+        return state_getter, attribute_getters
+
+    def _read_state(self, record):
+        """Call `record`'s state getter, if it has one; None if it has none or it fails."""
+        if not record.state_getter:
+            return None
+        try:
+            return record.state_getter()
+        except Exception as e:
+            logger.error(f"Error getting state of {record.unique_id}: {e}")
+            return None
+
+    def _initial_state(self, record, entity_config):
+        """Start reading an entity's state (and attributes) for setup on the initial-state
+        pool; resolve_initial_states() publishes it. One marked `deferred: true` in
+        entities.yaml (a slow getter) with a value retained from the last run publishes
+        that straight away instead, and its getter's answer whenever it comes."""
+        future = self._initial_state_pool.submit(self._timed_read, record)
+        retained = self._retained_states.get(record.entity.state_topic)
+        if entity_config.get('deferred') and retained is not None:
+            self._apply_initial_state(record, self._parse_retained(record, retained))
+            future.add_done_callback(functools.partial(self._apply_late_state, record))
+        else:
+            self._initial_state_futures[future] = record
+
+    def _timed_read(self, record):
+        """(state, attributes or None, seconds taken) for `record`."""
+        started = time.monotonic()
+        state = self._read_state(record)
+        attributes = record.attributes() if record.attribute_getters else None
+        return state, attributes, time.monotonic() - started
+
+    @staticmethod
+    def _parse_retained(record, payload):
+        """A retained state payload back as the value its getter would return."""
+        if record.component in ('binary_sensor', 'switch'):
+            return payload == record.entity._entity.payload_on
+        if record.component == 'number':
+            value = float(payload)
+            return int(value) if value.is_integer() else value
+        return payload
+
+    def _apply_initial_state(self, record, state, attributes=None):
+        unique_id = record.unique_id
+        try:
+            if record.component == 'binary_sensor':
+                # Falling back to False if it couldn't be resolved
+                if state is not None:
+                    logger.info(f"Sensor {unique_id} initialized with state: {state}")
+                else:
+                    logger.warning(f"Sensor {unique_id} state is None or could not be resolved; defaulting to False")
+                self.update_binary_sensor(unique_id, state if state is not None else False)
+            elif record.component == 'switch':
+                self.update_switch(unique_id, "ON" if state else "OFF")
+            elif state is None:
+                logger.warning(f"{record.component.capitalize()} {unique_id} state is None or could not be resolved")
+            elif record.component == 'number':
+                self.update_number(unique_id, state)
+            else:
+                self.update_sensor(unique_id, state)
+                logger.info(f"Sensor {unique_id} initialized with state: {state}")
+            # Declared attributes (e.g. "uptime" on "Current App"); re-read later
+            # on whatever their `depends_on:` lists
+            if attributes is not None:
+                self.update_sensor_attributes(unique_id, attributes)
+        except Exception as e:
+            logger.warning(f"Failed to set initial state of {unique_id}: {e}")
+
+    def _apply_late_state(self, record, future):
+        state, attributes, seconds = future.result()
+        logger.info(f"State of {record.unique_id} resolved in the background after {seconds:.2f}s")
+        self._apply_initial_state(record, state, attributes)
+
+    def resolve_initial_states(self, timeout=INITIAL_STATE_TIMEOUT):
+        """Wait (up to `timeout` seconds) for the state getters _initial_state started and
+        publish their answers; any still running are published when they finish. Logs
+        how long it took and the slowest getters."""
+        started = time.monotonic()
+        pending, self._initial_state_futures = self._initial_state_futures, {}
+        done, not_done = concurrent.futures.wait(pending, timeout)
+        timings = {}
+        for future in done:
+            state, attributes, timings[pending[future].unique_id] = future.result()
+            self._apply_initial_state(pending[future], state, attributes)
+        for future in not_done:
+            logger.warning(f"State of {pending[future].unique_id} not resolved within {timeout}s; publishing it when it is")
+            future.add_done_callback(functools.partial(self._apply_late_state, pending[future]))
+        self._initial_state_pool.shutdown()
+        slowest = ", ".join(f"{unique_id} {seconds:.2f}s" for unique_id, seconds
+                            in sorted(timings.items(), key=lambda item: item[1], reverse=True)[:5])
+        logger.info(f"Initial state of {len(done)}/{len(pending)} entities resolved in "
+                    f"{time.monotonic() - started:.2f}s (slowest: {slowest or 'none'})")
+
+    def restore_retained_state(self, timeout=RESTORE_TIMEOUT):
+        """Startup phase: collect the state and attributes the broker retained for this
+        device from the last run, and seed the published-value cache with them, so a
+        getter returning the same value again doesn't republish it. Gives up after
+        `timeout` seconds if the broker isn't reachable. Returns how many were restored."""
+        started = time.monotonic()
+        if not self._connected.wait(timeout):
+            logger.info("MQTT broker not reachable yet; starting without retained state")
+            return 0
+        filters = [f"{STATE_PREFIX}/+/{self._device_topic}/+/state", f"{STATE_PREFIX}/+/{self._device_topic}/+/attributes"]
+        self._restoring = True
+        self._last_restored_at = time.monotonic()
+        self.client.subscribe([(topic_filter, 1) for topic_filter in filters])
+        deadline = started + timeout
+        while time.monotonic() < min(self._last_restored_at + RESTORE_QUIET, deadline):
+            time.sleep(0.05)
+        self.client.unsubscribe(filters)
+        self._restoring = False
+        now = time.monotonic()
+        with self._publish_lock:
+            for topic, payload in self._retained_states.items():
+                self._last_published.setdefault(topic, (payload, now))
+        logger.info(f"Restored {len(self._retained_states)} retained state topic(s) in {now - started:.2f}s")
+        return len(self._retained_states)
+
+    def _watch_attributes(self, record, entity_config):
+        """Register a sensor's attributes for the events their `depends_on:` lists (see
+        invalidate()). One with its own `interval:` is re-read on that instead of the
+        entity's."""
+        for name, attribute in (entity_config.get('attributes') or {}).items():
+            if name not in record.attribute_getters:
+                continue
+            attribute = attribute if isinstance(attribute, dict) else {}
+            events = self.registry.depends_on(record.unique_id, name, attribute)
+            if attribute.get('interval'):
+                events.discard('interval')
+                self.refresh_scheduler.add(attribute['interval'], functools.partial(self.refresh_attributes, record, [name]))
+            record.attribute_depends[name] = events
+            for event in events - {'interval'}:
+                watchers = self._attribute_watchers.setdefault(event, [])
+                if record not in watchers:
+                    watchers.append(record)
+
+    def _schedule_refresh(self, record, entity_config):
+        """Honour an entities.yaml sensor/binary_sensor's `interval:` (seconds), if any."""
+        interval = entity_config.get('interval')
+        if interval:
+            self.refresh_scheduler.add(interval, functools.partial(self.refresh_entity, record))
+
+    def refresh_entity(self, record):
+        """Re-read an entity's state (and attributes) and publish them; unchanged values
+        are dropped by _publish as usual."""
+        state = self._read_state(record)
+        if state is not None:
+            if record.component == 'binary_sensor':
+                self.update_binary_sensor(record.unique_id, state)
+            elif record.component == 'switch':
+                self.update_switch(record.unique_id, "ON" if state else "OFF")
+            elif record.component == 'number':
+                self.update_number(record.unique_id, state)
+            else:
+                self.update_sensor(record.unique_id, state)
+        if record.attribute_getters:
+            self.refresh_attributes(record, record.attributes_depending_on('interval'))
+
+    def refresh_attributes(self, record, names):
+        """Re-read just the attributes `names` of `record` and publish its attributes; the
+        others keep their last values (an unchanged result is dropped by _publish)."""
+        if names:
+            self.update_sensor_attributes(record.unique_id, record.attributes(names))
+
+    def invalidate(self, event):
+        """Something attributes can depend on has changed (an ATTRIBUTE_EVENTS name, e.g.
+        "app_change" or "tv_state"): re-read and publish only the attributes whose
+        `depends_on:` lists it, so the work scales with what changed, not with how many
+        attributes entities.yaml declares. Their getters run on the command workers, not
+        the caller's thread (e.g. the CEC reader, which a CEC-querying getter would
+        block); a burst of the same event is read once."""
+        if event in self._attribute_watchers:
+            self.command_executor.submit(f"invalidate:{event}", "latest", self._refresh_watchers, event)
+
+    def _refresh_watchers(self, event):
+        for record in self._attribute_watchers.get(event, ()):
+            self.refresh_attributes(record, record.attributes_depending_on(event))
 
     def setup_discovery(self):
+        self.restore_retained_state(self.config.get('retained_restore_timeout', RESTORE_TIMEOUT))
+        # State getters run on a pool as entities are set up, so a slow one (CEC, wpctl)
+        # doesn't hold up the rest; resolve_initial_states() collects them
+        self._initial_state_pool = WorkerPool(self.config.get('initial_state_workers', INITIAL_STATE_WORKERS), "initial-state")
+        self._initial_state_futures = {}  # future -> EntityRecord
+        if self.discovery_mode != 'device':
+            self._remove_device_config()
         if 'binary_sensors' in self.entities and len(self.entities['binary_sensors']) > 0:
             self.setup_binary_sensors()
         if 'sensors' in self.entities and len(self.entities['sensors']) > 0:
             self.setup_sensors()
 
-        # Each entity below opens its own MQTT connection and is independent of the others,
-        # so set them up concurrently rather than paying for each connect handshake in turn.
-        jobs = [(self._setup_button, button) for button in self.entities.get('buttons', [])]
-        jobs += [(self._setup_switch, switch) for switch in self.entities.get('switches', [])]
-        jobs += [(self._setup_select, select) for select in self.entities.get('selects', [])]
-        jobs += [(self._setup_number, number) for number in self.entities.get('numbers', [])]
-        if jobs:
-            with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
-                futures = [executor.submit(setup_fn, entity) for setup_fn, entity in jobs]
-                concurrent.futures.wait(futures)
+        # All on the one shared connection, so each is just a few queued publishes
+        for button in self.entities.get('buttons', []):
+            self._setup_button(button)
+        for switch in self.entities.get('switches', []):
+            self._setup_switch(switch)
+        for select in self.entities.get('selects', []):
+            self._setup_select(select)
+        for number in self.entities.get('numbers', []):
+            self._setup_number(number)
+        self.resolve_initial_states(self.config.get('initial_state_timeout', INITIAL_STATE_TIMEOUT))
+        if self.registry.problems:
+            logger.warning(f"{len(self.registry.problems)} problem(s) in entities.yaml; see the errors above")
+        self._discovery_ready = True
+        if self.discovery_mode == 'device':
+            # Stale configs (e.g. per-entity ones from before switching modes) have to be
+            # gone before the device config claims the same unique_ids
+            self._configured.add(self.device_config_topic)
+            self._remove_stale_configs(keep_declared=False)
+            self._write_device_config()
+        else:
+            self._remove_stale_configs()
+        self._save_config_hashes()
+        self._clear_legacy_availability()
+        self.client.publish(self.availability_topic, "online", retain=True)
 
     def setup_binary_sensors(self):
         for sensor in self.entities['binary_sensors']:
@@ -136,36 +586,14 @@ class HomeAssistantClient:
                     expire_after=self.config.get('expire_after', None),
                     force_update=True
                 )
-                sensor_settings = Settings(mqtt=self.shared_mqtt_settings, entity=sensor_info, manual_availability=True)
-                binary_sensor = BinarySensor(sensor_settings)
-                binary_sensor.write_config()
-                binary_sensor.set_availability(True)
-                setattr(self, f"{sensor['unique_id']}_entity", binary_sensor)
-                self._shared_entities.append(binary_sensor)
-
-                # Resolve and set the initial state
-                state_method = sensor.get('state')
-                state = None
-                if state_method:
-                    try:
-                        # Resolve dotted paths like "utils.get_ip_address"
-                        parts = state_method.split('.')
-                        obj = self
-                        for part in parts[:-1]:  # Traverse to the parent object
-                            obj = getattr(obj, part)
-                        method = getattr(obj, parts[-1])  # Get the final method
-                        if callable(method):
-                            state = method()  # Call the resolved method
-                    except AttributeError as e:
-                        logger.error(f"Error resolving state method {state_method} for sensor {sensor['unique_id']}: {e}")
-
-                # Set the sensor state, falling back to False if it couldn't be resolved
-                if state is not None:
-                    binary_sensor.update_state(state)
-                    logger.info(f"Sensor {sensor['unique_id']} initialized with state: {state}")
-                else:
-                    binary_sensor.update_state(False)
-                    logger.warning(f"Sensor {sensor['unique_id']} state is None or could not be resolved; defaulting to False")
+                sensor_settings = Settings(mqtt=self.mqtt_settings, entity=sensor_info, manual_availability=True)
+                state_getter, _ = self._resolve_getters(sensor['unique_id'], sensor)
+                record = self._entity(BinarySensor, sensor_settings,
+                                      EntityRecord(sensor['unique_id'], 'binary_sensor', state_getter=state_getter))
+                self._write_config(record.entity)
+
+                self._initial_state(record, sensor)
+                self._schedule_refresh(record, sensor)
             except Exception as e:
                 logger.warning(f"Failed to set up binary sensor {sensor.get('unique_id')}: {e}")
 
@@ -184,28 +612,22 @@ class HomeAssistantClient:
                 force_update=True
             )
             button_settings = Settings(mqtt=self.mqtt_settings, entity=button_info, manual_availability=True)
-            button_entity = Button(button_settings, self.create_button_callback(button['callback'], button.get('args')))
-            button_entity.write_config()
-            button_entity.set_availability(True)
-            self._rebroadcast_availability_on_reconnect(button_entity)
-            setattr(self, f"{button['unique_id']}_entity", button_entity)
+            press = self.registry.resolve(button['unique_id'], button['callback'], "callback")
+            record = self._concurrency(EntityRecord(button['unique_id'], 'button', callbacks={'press': press}), button)
+            self._command_entity(Button, button_settings, record, self.create_button_callback(record, button.get('args')))
+            self._write_config(record.entity)
         except Exception as e:
             logger.warning(f"Failed to set up button {button.get('unique_id')}: {e}")
 
-    def create_button_callback(self, method_name, args=None):
+    def create_button_callback(self, record, args=None):
+        press = record.callbacks['press']
         def callback(client, userdata, message):
-            try:
-                # Resolve dotted paths like "tv.standby"
-                parts = method_name.split('.')
-                obj = self
-                for part in parts[:-1]:  # Traverse to the parent object
-                    obj = getattr(obj, part)
-                method = getattr(obj, parts[-1])  # Get the final method
-                method(*args) if args else method()  # Call the resolved method
-            except AttributeError as e:
-                logger.error(f"Callback method not found: {e}")
+            if not press:
+                logger.error(f"Button {record.unique_id} has no valid callback")
+                return
+            press(*args) if args else press()
         return callback
-    
+
     def _build_apps_options(self, none_option):
         """Shared by both the "{{apps_all}}" and "{{apps}}" options shorthands: build the
         options list and canonical<->display maps from apps.yaml, using each app's display
@@ -236,12 +658,6 @@ class HomeAssistantClient:
         that's actually running right now, like the app switcher."""
         return self._build_apps_options(NO_APP_RUNNING)
 
-    def _to_display(self, unique_id, canonical_value):
-        return self._select_maps.get(unique_id, {}).get('to_display', {}).get(canonical_value, canonical_value)
-
-    def _to_canonical(self, unique_id, display_value):
-        return self._select_maps.get(unique_id, {}).get('to_canonical', {}).get(display_value, display_value)
-
     def _setup_select(self, select):
         try:
             unique_id = select['unique_id']
@@ -252,9 +668,8 @@ class HomeAssistantClient:
 
             if uses_apps_shorthand:
                 options, to_canonical, to_display = self._apps_all_options() if uses_apps_all else self._apps_options()
-                self._select_maps[unique_id] = {'to_canonical': to_canonical, 'to_display': to_display}
             else:
-                options = raw_options
+                options, to_canonical, to_display = raw_options, {}, {}
 
             # entities.yaml's default_option (if any) is a canonical value (an app key,
             # or NONE_APP_OPTION) and wins if set. Otherwise, a "{{apps_all}}" select
@@ -278,11 +693,14 @@ class HomeAssistantClient:
                 force_update=True
             )
             select_settings = Settings(mqtt=self.mqtt_settings, entity=select_info, manual_availability=True)
-            select_entity = Select(select_settings, self.create_select_callback(select['callback'], unique_id))
-            select_entity.write_config()
-            select_entity.set_availability(True)
-            self._rebroadcast_availability_on_reconnect(select_entity)
-            setattr(self, f"{unique_id}_entity", select_entity)
+            # A plain callback name is a Supervisor method; a dotted path (e.g.
+            # "displays.bedroom.set_input_by_name") is resolved like a button's
+            method_name = select['callback']
+            select_callback = self.registry.resolve(unique_id, method_name if '.' in method_name else f"supervisor.{method_name}", "callback")
+            record = self._concurrency(EntityRecord(unique_id, 'select', callbacks={'select': select_callback},
+                                                    to_display=to_display, to_canonical=to_canonical), select)
+            self._command_entity(Select, select_settings, record, self.create_select_callback(record))
+            self._write_config(record.entity)
 
             # Persisted setting (if any) wins over the entities.yaml fallback default.
             # A persisted value that's no longer valid (e.g. an app key from before it
@@ -296,19 +714,17 @@ class HomeAssistantClient:
                 current_value = default_option
 
             if current_value:
-                select_entity.set_options(self._to_display(unique_id, current_value))
+                self.update_select(unique_id, current_value)
         except Exception as e:
             logger.warning(f"Failed to set up select {select.get('unique_id')}: {e}")
 
-    def create_select_callback(self, method_name, unique_id):
+    def create_select_callback(self, record):
+        select_callback = record.callbacks['select']
         def callback(client, userdata, message):
-            payload = message.payload.decode()
-            canonical_value = self._to_canonical(unique_id, payload)
-            try:
-                method = getattr(self.supervisor, method_name)
-                method(canonical_value)
-            except AttributeError as e:
-                logger.error(f"Callback method not found: {e}")
+            if not select_callback:
+                logger.error(f"Select {record.unique_id} has no valid callback")
+                return
+            select_callback(record.canonical_value(message.payload.decode()))
         return callback
 
     def _setup_number(self, number):
@@ -330,38 +746,29 @@ class HomeAssistantClient:
                 force_update=True
             )
             number_settings = Settings(mqtt=self.mqtt_settings, entity=number_info, manual_availability=True)
-            number_entity = Number(number_settings, self.create_number_callback(number['callback']))
-            number_entity.write_config()
-            number_entity.set_availability(True)
-            self._rebroadcast_availability_on_reconnect(number_entity)
-            setattr(self, f"{number['unique_id']}_entity", number_entity)
-
-            # Resolve and set the initial value
-            state_method = number.get('state')
-            state = None
-            if state_method:
-                try:
-                    state = self._resolve_dotted(state_method)()
-                except AttributeError as e:
-                    logger.error(f"Error resolving state method {state_method} for number {number['unique_id']}: {e}")
-            if state is not None:
-                number_entity.set_value(state)
-            else:
-                logger.warning(f"Number {number['unique_id']} state is None or could not be resolved")
+            state_getter, _ = self._resolve_getters(number['unique_id'], number)
+            set_value = self.registry.resolve(number['unique_id'], number['callback'], "callback")
+            record = self._concurrency(EntityRecord(number['unique_id'], 'number', state_getter=state_getter,
+                                                    callbacks={'set': set_value}), number)
+            self._command_entity(Number, number_settings, record, self.create_number_callback(record))
+            self._write_config(record.entity)
+
+            self._initial_state(record, number)
         except Exception as e:
             logger.warning(f"Failed to set up number {number.get('unique_id')}: {e}")
 
-    def create_number_callback(self, method_name):
+    def create_number_callback(self, record):
+        set_value = record.callbacks['set']
         def callback(client, userdata, message):
             try:
                 value = float(message.payload.decode())
             except ValueError as e:
-                logger.error(f"Invalid value for number callback {method_name}: {e}")
+                logger.error(f"Invalid value for number {record.unique_id}: {e}")
                 return
-            try:
-                self._resolve_dotted(method_name)(value)
-            except AttributeError as e:
-                logger.error(f"Callback method not found: {e}")
+            if not set_value:
+                logger.error(f"Number {record.unique_id} has no valid callback")
+                return
+            set_value(value)
         return callback
 
     def setup_sensors(self):
@@ -380,42 +787,15 @@ class HomeAssistantClient:
                     expire_after=self.config.get('expire_after', None),
                     force_update=True
                 )
-                sensor_settings = Settings(mqtt=self.shared_mqtt_settings, entity=sensor_info, manual_availability=True)
-                sensor_entity = Sensor(sensor_settings)
-                sensor_entity.write_config()
-                sensor_entity.set_availability(True)
-                self._shared_entities.append(sensor_entity)
-                setattr(self, f"{sensor['unique_id']}_entity", sensor_entity)
-
-                # Resolve and set the initial state
-                state_method = sensor.get('state')
-                state = None
-                if state_method:
-                    try:
-                        # Resolve dotted paths like "utils.get_ip_address"
-                        parts = state_method.split('.')
-                        obj = self
-                        for part in parts[:-1]:  # Traverse to the parent object
-                            obj = getattr(obj, part)
-                        method = getattr(obj, parts[-1])  # Get the final method
-                        if callable(method):
-                            state = method()  # Call the resolved method
-                    except AttributeError as e:
-                        logger.error(f"Error resolving state method {state_method} for sensor {sensor['unique_id']}: {e}")
-
-                # Set the sensor state or log a warning if state is None
-                if state is not None:
-                    sensor_entity.set_state(state)
-                    logger.info(f"Sensor {sensor['unique_id']} initialized with state: {state}")
-                else:
-                    logger.warning(f"Sensor {sensor['unique_id']} state is None or could not be resolved")
-
-                # Resolve and set any declared attributes (e.g. "uptime" on "Current App"),
-                # and remember the spec so refresh_sensor_attributes() can re-resolve it later
-                attribute_specs = sensor.get('attributes')
-                if attribute_specs:
-                    self._sensor_attribute_specs[sensor['unique_id']] = attribute_specs
-                    sensor_entity.set_attributes(self._resolve_attributes(attribute_specs))
+                sensor_settings = Settings(mqtt=self.mqtt_settings, entity=sensor_info, manual_availability=True)
+                state_getter, attribute_getters = self._resolve_getters(sensor['unique_id'], sensor)
+                record = self._entity(Sensor, sensor_settings, EntityRecord(
+                    sensor['unique_id'], 'sensor', state_getter=state_getter, attribute_getters=attribute_getters))
+                self._write_config(record.entity)
+
+                self._watch_attributes(record, sensor)
+                self._initial_state(record, sensor)
+                self._schedule_refresh(record, sensor)
             except Exception as e:
                 logger.warning(f"Failed to set up sensor {sensor.get('unique_id')}: {e}")
 
@@ -434,152 +814,186 @@ class HomeAssistantClient:
                 force_update=True
             )
             switch_settings = Settings(mqtt=self.mqtt_settings, entity=switch_info, manual_availability=True)
-            switch_entity = Switch(switch_settings, self.create_switch_callback(switch['on_callback'], switch['off_callback']))
-            switch_entity.write_config()
-            switch_entity.set_availability(True)
-            self._rebroadcast_availability_on_reconnect(switch_entity)
-            setattr(self, f"{switch['unique_id']}_entity", switch_entity)
-
-            # Resolve and set the initial state
-            state_method = switch.get('state')
-            state = None
-            if state_method:
-                try:
-                    # Resolve dotted paths like "tv.check_power_status"
-                    parts = state_method.split('.')
-                    obj = self
-                    for part in parts:  # Traverse through the parts to resolve the object
-                        obj = getattr(obj, part)
-                    if callable(obj):
-                        state = obj()  # Call the resolved method
-                    else:
-                        logger.warning(f"State method {state_method} is not callable for switch {switch['unique_id']}")
-                except AttributeError as e:
-                    logger.error(f"Error resolving state method {state_method} for switch {switch['unique_id']}: {e}")
-                    state = False
-
-            # Set the switch state based on the resolved state
-            if state:
-                switch_entity.on()
-            else:
-                switch_entity.off()
+            unique_id = switch['unique_id']
+            state_getter, _ = self._resolve_getters(unique_id, switch)
+            callbacks = {
+                'on': self.registry.resolve(unique_id, switch['on_callback'], "on_callback"),
+                'off': self.registry.resolve(unique_id, switch['off_callback'], "off_callback"),
+            }
+            record = self._concurrency(EntityRecord(unique_id, 'switch', state_getter=state_getter, callbacks=callbacks), switch)
+            self._command_entity(Switch, switch_settings, record, self.create_switch_callback(record))
+            self._write_config(record.entity)
+
+            self._initial_state(record, switch)
         except Exception as e:
             logger.warning(f"Failed to set up switch {switch.get('unique_id')}: {e}")
 
-    def create_switch_callback(self, on_callback, off_callback):
+    def create_switch_callback(self, record):
+        turn_on, turn_off = record.callbacks['on'], record.callbacks['off']
         def callback(client: mqtt.Client, userdata, message: mqtt.MQTTMessage):
             payload = message.payload.decode()
-            try:
-                if payload == "ON":
-                    # Resolve dotted paths for the ON callback
-                    parts = on_callback.split('.')
-                    obj = self
-                    for part in parts[:-1]:  # Traverse to the parent object
-                        obj = getattr(obj, part)
-                    method = getattr(obj, parts[-1])  # Get the final method
-                    method()  # Call the resolved method
-                elif payload == "OFF":
-                    # Resolve dotted paths for the OFF callback
-                    parts = off_callback.split('.')
-                    obj = self
-                    for part in parts[:-1]:  # Traverse to the parent object
-                        obj = getattr(obj, part)
-                    method = getattr(obj, parts[-1])  # Get the final method
-                    method()  # Call the resolved method
-            except AttributeError as e:
-                logger.error(f"Callback method not found: {e}")
+            method = turn_on if payload == "ON" else turn_off if payload == "OFF" else None
+            if payload in ("ON", "OFF") and not method:
+                logger.error(f"Switch {record.unique_id} has no valid {payload.lower()}_callback")
+            elif method:
+                method()
         return callback
 
-    def on_connect(self, client, userdata, flags, rc):
+    def on_connect(self, client, userdata, flags, rc, properties=None):
         logger.info(f"Connected to MQTT broker with result code {rc}")
-        # The MQTT LWT clears an entity's retained availability to "offline" the moment
-        # any connection drop is detected, even if the underlying client reconnects on
-        # its own right after — so every (re)connect needs to re-announce "online".
-        for entity in self._shared_entities:
-            entity.set_availability(True)
-
-    def on_disconnect(self, client, userdata, rc):
+        self._connected.set()
+        if self.topic_aliases:
+            # Aliases are per connection; the broker says how many it'll take (0 if none)
+            self.topic_aliases.reset(getattr(properties, 'TopicAliasMaximum', 0))
+            logger.info(f"MQTT v5 session {'resumed' if flags.get('session present') else 'started'}")
+        # The LWT flips the retained availability to "offline" the moment any connection
+        # drop is detected, even if the client reconnects right after -- so every
+        # (re)connect re-announces "online", and re-subscribes (the session may be new).
+        client.publish(self.availability_topic, "online", retain=True)
+        client.subscribe(self._command_subscription, qos=1)
+        # Forget the configs the broker held before: if it restarted without persistence
+        # they're gone, and re-subscribing redelivers whichever it still has
+        self._retained_configs.clear()
+        self._retained_config_ids.clear()
+        # Configs before HA's status, so a retained birth message is handled knowing
+        # which configs the broker already has
+        client.subscribe([(self._config_subscription, 1), (self.device_config_topic, 1)])
+        client.subscribe(HA_STATUS_TOPIC, qos=1)
+        # The broker may have restarted and lost its retained states while we were away,
+        # so the next value for every topic goes out even if it hasn't changed
+        with self._publish_lock:
+            self._last_published.clear()
+        # Send what changed while we were offline (held by the publish queue meanwhile)
+        self.publish_queue.set_connected(True)
+
+    def on_disconnect(self, client, userdata, rc, properties=None):
+        self._connected.clear()
+        self.publish_queue.set_connected(False)
         logger.warning(f"Disconnected from MQTT broker (result code {rc}); will keep retrying in the background")
 
     def on_message(self, client, userdata, message):
-        topic = message.topic.split("/")[-1]
-        self.retained_values[topic] = message.payload.decode()
-
-    def get_retained_value(self, unique_id):
-        return self.retained_values.get(unique_id, None)
-    
-    def update_binary_sensor(self, unique_id, state):
-        binary_sensor = getattr(self, f"{unique_id}_entity", None)
+        record = self.registry.by_command_topic.get(message.topic)
+        if record is not None:
+            self.command_executor.submit(record.unique_id, record.concurrency, record.on_command, client, userdata, message,
+                                         settle=record.settle)
+            return
+        if message.topic == HA_STATUS_TOPIC:
+            self.command_executor.submit(HA_STATUS_TOPIC, "latest", self._on_ha_status, client, userdata, message)
+            return
+        if message.topic.endswith("/config"):
+            if message.payload:
+                self._retained_configs[message.topic] = hashlib.sha256(message.payload).hexdigest()
+                try:
+                    config = json.loads(message.payload)
+                    self._retained_config_ids[message.topic] = config.get('unique_id', config.get('uniq_id'))
+                except (ValueError, AttributeError):
+                    pass
+            else:
+                self._retained_configs.pop(message.topic, None)
+                self._retained_config_ids.pop(message.topic, None)
+            return
+        if self._restoring and message.retain and message.topic.startswith(f"{STATE_PREFIX}/"):
+            self._retained_states[message.topic] = message.payload.decode()
+            self._last_restored_at = time.monotonic()
+
+    def _on_ha_status(self, client, userdata, message):
+        # HA's birth message: it has (re)started and needs our entities and state again
+        if message.payload.decode() == "online":
+            self.resync_home_assistant()
+
+    def _registered(self, unique_id):
+        record = self.registry.get(unique_id)
+        return record.entity if record else None
+
+    def update_binary_sensor(self, unique_id, state, force=False):
+        binary_sensor = self._registered(unique_id)
         if binary_sensor:
-            binary_sensor.update_state(state)
+            entity = binary_sensor._entity
+            self._publish(binary_sensor, binary_sensor.state_topic, entity.payload_on if state else entity.payload_off, force)
         else:
             logger.warning(f"Binary sensor with unique_id {unique_id} not found.")
 
-    def update_sensor(self, unique_id, state):
-        sensor = getattr(self, f"{unique_id}_entity", None)
+    def update_sensor(self, unique_id, state, force=False):
+        sensor = self._registered(unique_id)
         if sensor:
-            sensor.set_state(state)
+            self._publish(sensor, sensor.state_topic, str(state), force)
         else:
             logger.warning(f"Sensor with unique_id {unique_id} not found.")
 
-    def update_sensor_attributes(self, unique_id, attributes):
+    def update_sensor_attributes(self, unique_id, attributes, force=False):
         """Publish extra state attributes for a sensor, shown alongside its normal state."""
-        sensor = getattr(self, f"{unique_id}_entity", None)
+        sensor = self._registered(unique_id)
         if sensor:
-            sensor.set_attributes(attributes)
+            self._publish(sensor, sensor.attributes_topic, json.dumps(attributes), force)
         else:
             logger.warning(f"Sensor with unique_id {unique_id} not found.")
 
-    def update_select(self, unique_id, value):
-        select_entity = getattr(self, f"{unique_id}_entity", None)
-        if select_entity:
-            select_entity.set_options(self._to_display(unique_id, value))
+    def update_select(self, unique_id, value, force=False):
+        record = self.registry.get(unique_id)
+        if record:
+            self._publish(record.entity, record.entity.state_topic, record.display_value(value), force)
         else:
             logger.warning(f"Select with unique_id {unique_id} not found.")
 
     def update_select_options(self, unique_id, options):
         """Re-publish a select's available *options* (not just its current value) — the
         library has no dedicated method for this, so mutate the entity model directly."""
-        select_entity = getattr(self, f"{unique_id}_entity", None)
+        select_entity = self._registered(unique_id)
         if not select_entity:
             logger.warning(f"Select with unique_id {unique_id} not found.")
             return
         select_entity._entity.options = options
-        select_entity.write_config()
+        self._write_config(select_entity)
+        self._save_config_hashes()
 
-    def update_number(self, unique_id, value):
-        number_entity = getattr(self, f"{unique_id}_entity", None)
+    def update_number(self, unique_id, value, force=False):
+        number_entity = self._registered(unique_id)
         if number_entity:
-            number_entity.set_value(value)
+            entity = number_entity._entity
+            if not entity.min <= value <= entity.max:
+                raise RuntimeError(f"Value is not within configured boundaries [{entity.min}, {entity.max}]")
+            self._publish(number_entity, number_entity.state_topic, str(value), force)
         else:
             logger.warning(f"Number with unique_id {unique_id} not found.")
 
-    def update_switch(self, unique_id, state):
-        switch = getattr(self, f"{unique_id}_entity", None)
+    def update_switch(self, unique_id, state, force=False):
+        switch = self._registered(unique_id)
         if switch:
             if state == "ON":
-                switch.on()
+                self._publish(switch, switch.state_topic, switch._entity.payload_on, force)
             elif state == "OFF":
-                switch.off()
+                self._publish(switch, switch.state_topic, switch._entity.payload_off, force)
         else:
             logger.warning(f"Switch with unique_id {unique_id} not found.")
 
-    def cleanup(self):
+    def cleanup(self, timeout=2):
+        """Go offline in HA and disconnect, spending at most about `timeout` seconds
+        waiting on the broker."""
         logger.info("Cleaning up Home Assistant client")
+        deadline = time.monotonic() + timeout
 
-        # Publish "offline" availability for each entity
-        for entity_type in ['sensors', 'switches', 'buttons', 'binary_sensors', 'selects', 'numbers']:
-            if entity_type in self.entities:
-                for entity in self.entities[entity_type]:
-                    unique_id = entity['unique_id']
-                    entity_id = getattr(self, f"{unique_id}_entity", None)
-                    if entity_id:
-                        entity_id.set_availability(False)
-                        logger.info(f"Set {entity_type[:-1]} {unique_id} to offline")
-                    else:
-                        logger.warning(f"{entity_type[:-1].capitalize()} with unique_id {unique_id} not found.")
+        # Let queued state go out first, then one device-wide "offline" covers every
+        # entity; wait for it to actually go out before disconnecting
+        if not self.publish_queue.flush(timeout=timeout / 2):
+            logger.warning("Timed out flushing queued state publishes")
+        message_info = self.client.publish(self.availability_topic, "offline", retain=True)
+        try:
+            message_info.wait_for_publish(timeout=max(deadline - time.monotonic(), 0.1))
+        except (RuntimeError, ValueError) as e:
+            logger.warning(f"Couldn't publish offline availability: {e}")
+        logger.info("Set all entities to offline")
+        logger.info(f"State publishes: {self.publish_counts['sent']} sent, {self.publish_counts['suppressed']} unchanged and suppressed")
+        wire_bytes, v311_bytes = self.publish_queue.counts['bytes'], self.publish_queue.counts['bytes_v311']
+        if self.v5 and v311_bytes:
+            logger.info(f"State publishes took {wire_bytes} bytes over MQTT v5 vs {v311_bytes} as 3.1.1 "
+                        f"({1 - wire_bytes / v311_bytes:.0%} saved)")
+        for key, stats in self.command_executor.stats().items():
+            logger.info(f"Commands for {key}: {stats['completed']}/{stats['received']} run, {stats['superseded']} superseded, "
+                        f"{stats['dropped']} dropped, max queue {stats['max_depth']}, "
+                        f"wait {stats['wait_avg']:.3f}s avg/{stats['wait_max']:.3f}s max, run {stats['run_avg']:.3f}s avg/{stats['run_max']:.3f}s max")
+        self.command_executor.shutdown()
 
         # Stop MQTT client
-        self.client.loop_stop()
         self.client.disconnect()
+        self.client.loop_stop()
         logger.info("Home Assistant client cleaned up")
@@ -0,0 +1,80 @@
+"""MQTT v5 extras for the shared Home Assistant connection (config.yaml `mqtt_version: 5`):
+topic aliases and message expiry for state publishes, session expiry on connect, and the
+PUBLISH packet sizes used to compare v5's bytes on the wire with 3.1.1's."""
+
+import collections
+import logging
+import threading
+from paho.mqtt.packettypes import PacketTypes
+from paho.mqtt.properties import Properties
+
+logger = logging.getLogger(__name__)
+
+ALIAS_AFTER = 3  # publishes to a topic before it's worth one of the broker's few aliases
+SESSION_EXPIRY = 300  # seconds the broker keeps our session (subscriptions, queued QoS 1) after a drop
+
+def connect_properties(session_expiry=SESSION_EXPIRY):
+    properties = Properties(PacketTypes.CONNECT)
+    properties.SessionExpiryInterval = session_expiry
+    return properties
+
+def _varint_size(value):
+    size = 1
+    while value > 127:
+        value >>= 7
+        size += 1
+    return size
+
+def _encode(payload):
+    if isinstance(payload, bytes):
+        return payload
+    return b"" if payload is None else str(payload).encode()
+
+def publish_size(topic, payload, qos, properties=None, v5=True):
+    """Bytes a PUBLISH packet for this takes on the wire (fixed header included)."""
+    remaining = 2 + len(topic.encode()) + (2 if qos else 0) + len(_encode(payload))
+    if v5:
+        remaining += len(properties.pack()) if properties is not None else 1
+    return 1 + _varint_size(remaining) + remaining
+
+class TopicAliases:
+    """Topic aliases for the state topics PublishQueue sends: the first publish to a topic
+    on a connection carries the topic and a number, later ones just the number. Aliases
+    go to topics as they become frequent (ALIAS_AFTER publishes), up to the smaller of
+    `maximum` and what the broker allows. They only last one connection, so reset() is
+    called on every connect.
+
+    Only QoS 0 publishes use them: paho re-sends unacknowledged QoS 1/2 publishes on the
+    next connection, where an alias-only one would be a protocol error."""
+
+    def __init__(self, maximum=10):
+        self.maximum = maximum
+        self._limit = 0  # set from the broker's CONNACK by reset()
+        self._aliases = {}  # topic -> alias the broker knows it by on this connection
+        self._counts = collections.Counter()  # topic -> publishes, across connections
+        self._lock = threading.Lock()
+
+    def reset(self, broker_maximum):
+        with self._lock:
+            self._limit = min(self.maximum, broker_maximum)
+            self._aliases = {}
+        logger.debug(f"Using up to {self._limit} topic aliases")
+
+    def publish(self, client, topic, payload, qos, retain, properties):
+        """client.publish() `payload` to `topic`, by alias where there is (or can now be)
+        one. Returns (paho's MQTTMessageInfo, the topic actually sent: "" for alias only)."""
+        with self._lock:
+            self._counts[topic] += 1
+            alias = self._aliases.get(topic)
+            known = alias is not None
+            if not known and qos == 0 and self._counts[topic] >= ALIAS_AFTER and len(self._aliases) < self._limit:
+                alias = len(self._aliases) + 1
+            if alias is None or qos:
+                return client.publish(topic, payload, qos=qos, retain=retain, properties=properties), topic
+            properties.TopicAlias = alias
+            sent_topic = "" if known else topic
+            result = client.publish(sent_topic, payload, qos=qos, retain=retain, properties=properties)
+            # Only a delivered first publish teaches the broker the alias
+            if not known and not result.rc:
+                self._aliases[topic] = alias
+            return result, sent_topic
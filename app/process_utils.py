@@ -3,6 +3,7 @@ import os
 import signal
 import subprocess
 import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -63,16 +64,36 @@ def spawn_logged(command, cwd, env, log_path, max_log_bytes, stream_logger=None,
 def terminate_process_group(process, timeout=5):
     """Stop a process (and its whole process group) gracefully, escalating to SIGKILL
     if it doesn't exit within `timeout` seconds."""
-    if process.poll() is not None:
-        return
+    terminate_process_groups([process], timeout)
+
+
+def terminate_process_groups(processes, timeout=5):
+    """terminate_process_group for several processes at once: every group gets SIGTERM
+    up front and they share one `timeout`, so stopping N of them takes as long as the
+    slowest rather than the sum."""
+    running = [process for process in processes if process.poll() is None]
+    for process in running:
+        _signal_group(process, signal.SIGTERM)
+    deadline = time.monotonic() + timeout
+    survivors = [process for process in running if not _wait_until(process, deadline)]
+    for process in survivors:
+        _signal_group(process, signal.SIGKILL)
+    deadline = time.monotonic() + 2
+    for process in survivors:
+        _wait_until(process, deadline)
+
+
+def _signal_group(process, sig):
     try:
-        os.killpg(os.getpgid(process.pid), signal.SIGTERM)
-        process.wait(timeout=timeout)
-        return
-    except (subprocess.TimeoutExpired, ProcessLookupError):
+        os.killpg(os.getpgid(process.pid), sig)
+    except ProcessLookupError:
         pass
+
+
+def _wait_until(process, deadline):
+    """Wait for `process` to exit by `deadline` (a time.monotonic() value); True if it did."""
     try:
-        os.killpg(os.getpgid(process.pid), signal.SIGKILL)
-        process.wait(timeout=2)
-    except (subprocess.TimeoutExpired, ProcessLookupError):
-        pass
+        process.wait(timeout=max(deadline - time.monotonic(), 0))
+        return True
+    except subprocess.TimeoutExpired:
+        return False
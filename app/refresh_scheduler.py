@@ -0,0 +1,62 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class RefreshScheduler:
+    """Runs periodic refresh jobs (e.g. re-reading a sensor's `state` for entities.yaml's
+    `interval:`) on one thread, driven by a min-heap of due times. Jobs with the same
+    interval form one batch that runs together, and `before_batch` is called ahead of each
+    one, so getters sharing a data source read it once per batch (see
+    Utils.begin_refresh_batch); each batch starts at a random offset and drifts by up to
+    `jitter` (a fraction of its interval) per run, so batches don't all land on the
+    same tick."""
+
+    JITTER = 0.1  # +/- fraction of a batch's interval added to each run's due time
+
+    def __init__(self, jitter=JITTER, before_batch=None):
+        self.jitter = jitter
+        self.before_batch = before_batch
+        self._batches = {}  # interval (seconds) -> [job, ...]
+        self._heap = []  # (due monotonic time, tiebreak, interval)
+        self._sequence = itertools.count()
+        self._changed = threading.Condition()
+        threading.Thread(target=self._run, name="refresh-scheduler", daemon=True).start()
+
+    def add(self, interval, job):
+        """Call `job()` every `interval` seconds, from the next batch of that interval on."""
+        with self._changed:
+            batch = self._batches.get(interval)
+            if batch is not None:
+                batch.append(job)
+                return
+            self._batches[interval] = [job]
+            heapq.heappush(self._heap, (time.monotonic() + random.uniform(0, interval), next(self._sequence), interval))
+            self._changed.notify()
+
+    def _run(self):
+        while True:
+            with self._changed:
+                while not self._heap or self._heap[0][0] > time.monotonic():
+                    self._changed.wait(self._heap[0][0] - time.monotonic() if self._heap else None)
+                due, _, interval = heapq.heappop(self._heap)
+                jobs = list(self._batches[interval])
+            if self.before_batch:
+                try:
+                    self.before_batch()
+                except Exception:
+                    logger.exception("Refresh before_batch hook failed")
+            for job in jobs:
+                try:
+                    job()
+                except Exception:
+                    logger.exception(f"Refresh job {job} failed")
+            # Next run measured from this one's due time, so a slow batch doesn't drift,
+            # but never scheduled in the past (no burst of catch-up runs after a stall)
+            next_due = max(due + interval * (1 + random.uniform(-self.jitter, self.jitter)), time.monotonic())
+            with self._changed:
+                heapq.heappush(self._heap, (next_due, next(self._sequence), interval))
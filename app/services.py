@@ -3,7 +3,7 @@ import os
 import threading
 import time
 
-from .process_utils import spawn_logged, terminate_process_group
+from .process_utils import spawn_logged, terminate_process_group, terminate_process_groups
 
 logger = logging.getLogger(__name__)
 
@@ -79,10 +79,19 @@ class ServiceManager:
             terminate_process_group(process)
         self._notify(name, False)
 
-    def stop_all(self):
-        """Stop every currently-running service — used on supervisor shutdown."""
-        for name in list(self._running.keys()):
-            self.stop(name)
+    def stop_all(self, timeout=5):
+        """Stop every currently-running service — used on supervisor shutdown. They're
+        all signalled together and share one `timeout`."""
+        with self._lock:
+            stopping = dict(self._running)
+            for name in stopping:
+                self._generation[name] = self._generation.get(name, 0) + 1  # stand down any in-flight monitor
+            self._running.clear()
+            if stopping:
+                logger.info(f"Stopping services: {', '.join(stopping)}")
+            terminate_process_groups(list(stopping.values()), timeout)
+        for name in stopping:
+            self._notify(name, False)
 
     def start_autostart(self):
         """Start every service declared with `autostart: true` — mirrors what
@@ -1,5 +1,6 @@
 import logging
 import os
+import threading
 import yaml
 
 logger = logging.getLogger(__name__)
@@ -11,6 +12,7 @@ class SettingsStore:
     def __init__(self, path="settings.yaml"):
         self.path = path
         os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
         self._data = self._load()
 
     def _load(self):
@@ -27,6 +29,17 @@ class SettingsStore:
         return self._data.get(key, default)
 
     def set(self, key, value):
-        self._data[key] = value
-        self._save()
+        with self._lock:
+            self._data[key] = value
+            self._save()
         logger.info(f"Setting '{key}' updated to '{value}'")
+
+    def update(self, values):
+        """Set several keys with a single write, skipped entirely if none of them changed."""
+        with self._lock:
+            changed = [key for key, value in values.items() if self._data.get(key) != value]
+            if not changed:
+                return
+            self._data.update(values)
+            self._save()
+        logger.debug(f"Settings updated in {self.path}: {', '.join(changed)}")
@@ -0,0 +1,68 @@
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class ShutdownCoordinator:
+    """Runs the supervisor's teardown phases (going offline in HA, stopping the app and
+    services, releasing GPIOs) all at once, on daemon threads, under one overall
+    deadline -- so a restart takes as long as the slowest phase, and a phase that hangs
+    can't hold the process up past the deadline -- exit() included."""
+
+    DEADLINE = 3  # seconds the whole shutdown may take
+
+    def __init__(self, deadline=DEADLINE):
+        self.deadline = deadline
+        self._phases = []  # (name, fn)
+        self._started = None
+
+    def add(self, name, fn, *args, **kwargs):
+        self._phases.append((name, functools.partial(fn, *args, **kwargs)))
+
+    def run(self):
+        """Run every phase and wait for them (up to the deadline). Returns {name: seconds
+        taken, or None if it was still running at the deadline}."""
+        started = self._started = time.monotonic()
+        timings = {}
+        threads = []
+        for name, fn in self._phases:
+            thread = threading.Thread(target=self._run_phase, args=(name, fn, started, timings),
+                                      name=f"shutdown-{name}", daemon=True)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join(max(started + self.deadline - time.monotonic(), 0))
+        results = {name: timings.get(name) for name, _ in self._phases}
+        breakdown = ", ".join(f"{name} {seconds:.2f}s" if seconds is not None else f"{name} unfinished"
+                              for name, seconds in results.items())
+        logger.info(f"Shutdown took {time.monotonic() - started:.2f}s ({breakdown})")
+        return results
+
+    def exit(self, status=0):
+        """sys.exit(status), forced with os._exit() if the interpreter is still exiting
+        at the deadline, e.g. stuck joining a non-daemon thread."""
+        remaining = self.deadline - (time.monotonic() - self._started) if self._started else self.deadline
+        watchdog = threading.Timer(max(remaining, 0.1), self._force_exit, args=(status,))
+        watchdog.daemon = True
+        watchdog.start()
+        sys.exit(status)
+
+    @staticmethod
+    def _force_exit(status):
+        stuck = ", ".join(thread.name for thread in threading.enumerate()
+                          if thread.is_alive() and not thread.daemon and thread is not threading.main_thread())
+        logger.warning(f"Shutdown deadline passed; exiting now (still running: {stuck or 'none'})")
+        logging.shutdown()
+        os._exit(status)
+
+    @staticmethod
+    def _run_phase(name, fn, started, timings):
+        try:
+            fn()
+        except Exception:
+            logger.exception(f"Shutdown phase '{name}' failed")
+        timings[name] = time.monotonic() - started
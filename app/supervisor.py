@@ -2,8 +2,6 @@ import json
 import subprocess
 import logging
 import os
-import threading
-import time
 from .apps import AppManager
 from .services import ServiceManager
 from .utils import format_duration
@@ -11,7 +9,6 @@ from .utils import format_duration
 NONE_APP_OPTION = "No Startup App"  # not "None" -- HA's MQTT integration treats that as a reserved sentinel
 NO_APP_RUNNING = "Nothing Running"  # "Current App" sensor's state when no app is running
 
-UPTIME_REFRESH_INTERVAL = 30  # seconds between uptime sensor/attribute refreshes
 
 # Display name -> UxPlay CLI flag(s). "Normal" maps to no extra args at all.
 UXPLAY_ROTATION_OPTIONS = {
@@ -42,7 +39,6 @@ class Supervisor:
             user_home=user_home, secrets=secrets,
             on_state_change=self._on_service_state_change
         )
-        threading.Thread(target=self._uptime_loop, daemon=True).start()
 
     def notify(self, title, message):
         """Send a notification to the desktop."""
@@ -129,20 +125,13 @@ class Supervisor:
             return
         self.ha_client.update_sensor("current_app", self.get_current_app_display_name())
         self.ha_client.update_select("app_switcher", self.apps.current_app or NO_APP_RUNNING)
+        self.ha_client.invalidate("app_change")  # e.g. Current App's "uptime" attribute
         self._push_uptimes()
 
-    def _uptime_loop(self):
-        """Keep uptime-flavored sensors/attributes ticking for as long as the supervisor runs."""
-        while True:
-            time.sleep(UPTIME_REFRESH_INTERVAL)
-            self._push_uptimes()
-
     def _push_uptimes(self):
         if not self.ha_client:
             return
 
-        self.ha_client.refresh_sensor_attributes()  # e.g. Current App's "uptime" attribute
-
         if self.utils:
             self.ha_client.update_sensor("pi_uptime", self.utils.get_pi_uptime())
             self.ha_client.update_sensor("supervisor_uptime", self.utils.get_supervisor_uptime())
@@ -163,10 +152,7 @@ class Supervisor:
 
     def set_tv_input(self, value):
         """Callback for the "TV Input" select. Anything but the Pi's name maps to hdmi."""
-        if value == self.tv.inputs['rPi']['name']:
-            self.tv.set_input_rpi()
-        else:
-            self.tv.set_input_hdmi()
+        self.tv.set_input_by_name(value)
 
     def _on_service_state_change(self, name, running):
         """ServiceManager callback: keep a service's HA switch in sync."""
@@ -1,58 +1,131 @@
-import os
-import subprocess
-import re
+import itertools
 import time
 import threading
 import logging
 
-from .process_utils import terminate_process_group
+from concurrent.futures import CancelledError, Future
+
+from .cec import (
+    CecClientBackend, CecCommandQueue, ScanResult, POWER_STATUS_NAMES, PRIORITY_BACKGROUND, PRIORITY_USER, OPCODE_ACTIVE_SOURCE, OPCODE_REPORT_POWER_STATUS, OPCODE_REQUEST_ACTIVE_SOURCE,
+    OPCODE_ROUTING_CHANGE, OPCODE_SET_STREAM_PATH, OPCODE_STANDBY,
+)
+from .cec_linux import LinuxCecBackend
 
 class TV:
     CEC_TIMEOUT = 10   # seconds, for most commands
     SCAN_TIMEOUT = 20  # "scan" walks the whole bus, so it needs more time
-    POLL_INTERVAL = 60  # seconds between background power/input polls
+    SCAN_CACHE_TTL = 30  # seconds one scan answers every lookup before another bus walk
+    POLL_INTERVAL = 60  # seconds between checks for whether a reconciliation scan is due
+    RECONCILE_AFTER = 600  # seconds of bus silence before falling back to a full power check + scan
+
+    # Input-switch confirmation: re-ask "who's the active source?" after each of these
+    # waits (seconds; the last repeats), stopping early as soon as the bus answers.
+    INPUT_CONFIRM_BACKOFF = (0.25, 0.5, 1, 2)
+    INPUT_CONFIRM_TIMEOUT = 10
+    # Neither the Pi nor a non-CEC device answers <Request Active Source>, so a switch
+    # nothing has contradicted for this long (with the TV on) counts as done -- though
+    # not as confirmed, so it isn't timed (see last_input_switch_seconds).
+    INPUT_UNCONTESTED_AFTER = 1.5
+
+    # Power states. TURNING_ON/TURNING_OFF run from a command (or the TV reporting it's
+    # in transition) until the TV confirms the target state or POWER_TRANSITION_TIMEOUT
+    # passes; repeat requests in the meantime are absorbed rather than re-sent.
+    POWER_UNKNOWN = "unknown"
+    POWER_OFF = "off"
+    POWER_TURNING_ON = "turning on"
+    POWER_ON = "on"
+    POWER_TURNING_OFF = "turning off"
+    POWER_TRANSITION_TIMEOUT = 60
+    # Backend power status names (see cec.POWER_STATUS_NAMES) -> power state
+    POWER_STATUS_STATES = {
+        "on": POWER_ON,
+        "standby": POWER_OFF,
+        "in transition from standby to on": POWER_TURNING_ON,
+        "in transition from on to standby": POWER_TURNING_OFF,
+    }
+    # While a transition is in progress, re-check power status after each of these waits
+    # (seconds; the last repeats) unless bus traffic confirms it first.
+    POWER_CONFIRM_BACKOFF = (1, 2, 4, 5)
 
-    # Fallback if config.yaml doesn't declare tv_inputs. Physical CEC address per input.
+    # Fallback if a display doesn't declare inputs. Physical CEC address per input.
     DEFAULT_INPUTS = {
         'rPi': {'name': 'Raspberry Pi', 'address': '2.0.0.0'},
         'hdmi': {'name': 'HDMI 3', 'address': '3.0.0.0'},
     }
 
-    def __init__(self, address, ha_client, inputs=None):
+    def __init__(self, address, ha_client, inputs=None, cec_backend="auto", cec_device="/dev/cec0", inventory=None,
+                 display_id="tv", entity_prefix=None, cec_client_port=None):
         self.address = address
         self.ha_client = ha_client
         self.inputs = inputs or self.DEFAULT_INPUTS
-        self.lock = threading.RLock()  # serializes all cec-client access
-
-        # Currently-running cec-client process, so a user command can cancel it if it's
-        # just the background poll (see _acquire_for_command). Own lock since it's read
-        # from a thread that doesn't hold self.lock.
-        self._current_process = None
-        self._current_is_background = False
-        self._current_op_lock = threading.Lock()
+        self.display_id = display_id
+        # This display's Home Assistant entities are "<prefix>_power", "<prefix>_input", ...
+        self.entity_prefix = entity_prefix or display_id
+        # SettingsStore holding the last known devices, input and power (see
+        # _save_inventory), so state is right from the first moment rather than after
+        # the startup power check and scan. None to not persist anything.
+        self.inventory = inventory
+        self._last_traffic = time.monotonic()  # last frame received from another device
+
+        # Bumped by each new power/input request, so an older request's confirmation
+        # loop can tell it's been superseded and stand down (see _begin_request).
+        self._request_generation = {'power': 0, 'input': 0}
+        self._request_lock = threading.RLock()
+        # Future of the request each kind is currently confirming, which a repeat of the
+        # same request shares rather than starting its own
+        self._pending = {'power': None, 'input': None}
+
+        # Latest (input key or None, monotonic time) some device reported as the active
+        # source, and a condition wait_for_input_switch() sleeps on between probes.
+        self._active_report = (None, 0.0)
+        self._active_report_changed = threading.Condition()
+        self.last_input_switch_seconds = None  # time-to-confirmed of the last bus-confirmed input switch
+        self.input_switch_outcomes = {'confirmed': 0, 'uncontested': 0, 'unconfirmed': 0}
+        self._scan_cache = None  # latest successful ScanResult; see _scan()
+
+        self.power_state = self.POWER_UNKNOWN
+        self._power_changed = threading.Condition()  # guards power_state; notified on every change
+        self._transition_deadline = 0.0  # monotonic time the current TURNING_* state expires
+        self.internal_input = "Unknown"
+        self.switching_to = None  # input key while an input switch is being confirmed
+        self._published_input = (None, None)  # (current input, selection) last sent to Home Assistant
+        self._hdmi_label = self.inputs['hdmi']['name']
+        # True until the startup power check and scan have confirmed (or corrected) what
+        # _load_inventory() restored
+        self.provisional = self._load_inventory()
+
+        # Bus traffic from the backend drives state updates directly (see _on_cec_frame),
+        # so polling is only a fallback. Opened last: a kernel backend starts delivering
+        # frames straight away.
+        self.backend = self._open_backend(cec_backend, cec_device, cec_client_port)
+        # Every bus transaction goes through here: user commands ahead of background
+        # polls, duplicate queries merged, a newer power/input command replacing a
+        # still-queued one. A user command also abandons an in-progress background scan.
+        self.commands = CecCommandQueue(on_preempt=self.backend.abort)
 
-        self.is_on = False
         self.power_thread = threading.Thread(target=self.initialize_power_status, daemon=True)
         self.power_thread.start()
 
-        self.internal_input = "Unknown"
-        self._hdmi_label = self.inputs['hdmi']['name']
-
         self.input_thread = threading.Thread(target=self.initialize_input, daemon=True)
         self.input_thread.start()
 
         threading.Thread(target=self._poll_loop, daemon=True).start()
 
     def _poll_loop(self):
-        """Catches input/power changes made via the TV's own remote."""
+        """Catches input/power changes made via the TV's own remote that never showed up
+        as bus traffic. Most do, and are applied as they arrive (see _on_cec_frame), so
+        this only reconciles once the bus has been quiet for RECONCILE_AFTER."""
         while True:
             time.sleep(self.POLL_INTERVAL)
-            self.check_power_status()
+            if time.monotonic() - self._last_traffic < self.RECONCILE_AFTER:
+                continue
+            self._last_traffic = time.monotonic()  # a silent bus reconciles once per RECONCILE_AFTER, not every poll
+            logging.info("No CEC traffic for a while; reconciling TV state with a full scan")
+            self.check_power_status(background=True)
             if self.is_on:
-                # One scan shared by both lookups below, not two separate cec-client calls.
-                output = self._run_cec_command("scan", timeout=self.SCAN_TIMEOUT, background=True)
-                self._apply_hdmi_label(self._parse_hdmi_device_name(output))
-                self._parse_active_source(output)
+                scan = self._scan(background=True, max_age=0)
+                self._apply_hdmi_label(self._parse_hdmi_device_name(scan))
+                self._parse_active_source(scan)
                 self.update_input()
 
     def initialize_power_status(self):
@@ -60,10 +133,10 @@ class TV:
         logging.info(f"TV initialized. Power: {'ON' if self.is_on else 'OFF'}")
 
     def initialize_input(self):
-        output = self._run_cec_command("scan", timeout=self.SCAN_TIMEOUT)
-        self._apply_hdmi_label(self._parse_hdmi_device_name(output))
+        scan = self._scan()
+        self._apply_hdmi_label(self._parse_hdmi_device_name(scan))
 
-        detected_input = self._parse_active_source(output)
+        detected_input = self._parse_active_source(scan)
 
         if detected_input == "Unknown":
             logging.warning("TV input is 'unknown' on startup, switching to rPi")
@@ -72,209 +145,393 @@ class TV:
             logging.info(f"TV input detected on startup: {detected_input}")
             self.internal_input = detected_input
             self.update_input()
-
-    def _run_cec_command(self, cec_command, timeout=None, background=False):
-        """Run a cec-client command, returning its stdout (empty on failure/timeout).
-        Runs in its own process group and is fully killed on timeout, not just the shell
-        wrapper. `background=True` marks it cancellable by _acquire_for_command."""
-        timeout = timeout or self.CEC_TIMEOUT
-        with self.lock:
-            process = subprocess.Popen(
-                f"echo '{cec_command}' | cec-client -s -d 1",
-                shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True,
-                preexec_fn=os.setsid
-            )
-            with self._current_op_lock:
-                self._current_process = process
-                self._current_is_background = background
-            try:
-                stdout, _ = process.communicate(timeout=timeout)
-                return stdout
-            except subprocess.TimeoutExpired:
-                logging.error(f"cec-client command '{cec_command}' timed out after {timeout}s")
-                terminate_process_group(process, timeout=2)  # short grace, it already overran
-                return ""
-            finally:
-                with self._current_op_lock:
-                    if self._current_process is process:
-                        self._current_process = None
-                        self._current_is_background = False
-
-    def _acquire_for_command(self, description):
-        """Acquire self.lock for a user command. Cancels an in-progress background scan
-        rather than waiting for it; never cancels another user command."""
-        if self.lock.acquire(blocking=False):
-            return True
-
-        with self._current_op_lock:
-            process = self._current_process
-            is_background = self._current_is_background
-        if process is None or not is_background:
+        self.power_thread.join()
+        if self.provisional:
+            logging.info("TV state restored from the inventory has been reconciled with the bus")
+        self.provisional = False
+
+    def _load_inventory(self):
+        """Restore the last known HDMI label, input and power from the inventory.
+        Returns whether there was anything to restore."""
+        if self.inventory is None or not self.inventory.get('devices') and self.inventory.get('power') is None:
             return False
+        device = self.inventory.get('devices', {}).get(self.inputs['hdmi']['address'])
+        self._hdmi_label = (device and device.get('name')) or self.inputs['hdmi']['name']
+        self.internal_input = self.inventory.get('input') or "Unknown"
+        self.power_state = {'on': self.POWER_ON, 'off': self.POWER_OFF}.get(self.inventory.get('power'), self.POWER_UNKNOWN)
+        logging.info(f"TV state restored from inventory (provisional): power {self.power_state}, input {self.internal_input}, HDMI label {self._hdmi_label}")
+        return True
+
+    def _save_inventory(self, scan=None):
+        """Persist the current input and power, plus the devices from `scan` if given.
+        Only written when something actually changed."""
+        if self.inventory is None:
+            return
+        values = {'input': self.internal_input}
+        if self.power_state in (self.POWER_ON, self.POWER_OFF):
+            values['power'] = 'on' if self.power_state == self.POWER_ON else 'off'
+        if scan is not None:
+            values['devices'] = {
+                device.address: {'name': device.osd_name, 'vendor': device.vendor, 'logical_address': device.number}
+                for device in scan.devices if device.address
+            }
+        try:
+            self.inventory.update(values)
+        except OSError as e:
+            logging.warning(f"Failed to save TV inventory: {e}")
 
-        logging.info(f"Cancelling in-progress background scan to run: {description}")
-        terminate_process_group(process, timeout=2)
-        return self.lock.acquire(blocking=True, timeout=5)
-
-    def check_power_status(self):
-        """Check if the TV is on or in standby and update Home Assistant."""
-        power_status = False
-        output = self._run_cec_command(f"pow {self.address}").lower()
-
-        logging.info(f"Checking TV power status... Raw output: {output.strip()}")
+    def _entity(self, suffix):
+        return f"{self.entity_prefix}_{suffix}"
 
-        if "power status: on" in output:
-            power_status = True
-        elif "power status: standby" in output or "power status: in transition from standby to on" in output:
-            power_status = False
-        else:
-            logging.warning("Unexpected power status response, assuming TV is OFF.")
-            power_status = False
+    def publish_state(self):
+        """Push everything TV reports to Home Assistant in one go -- meant for right
+        after discovery, when the restored inventory may be all that's known yet."""
+        if not self.ha_client:
+            return
+        self.ha_client.update_select_options(self._entity("input"), [self.inputs['rPi']['name'], self._hdmi_label])
+        self._published_input = (None, None)
+        self._publish_power()
 
-        self.is_on = power_status  # set before update_input(), which reads it
+    @classmethod
+    def from_config(cls, display, ha_client=None, inventory=None):
+        """A TV for one entry of display_configs()."""
+        return cls(
+            display.get('address', "0.0.0.0"), ha_client, inputs=display.get('inputs'),
+            cec_backend=display.get('cec_backend', "auto"), cec_device=display.get('cec_device', "/dev/cec0"),
+            cec_client_port=display.get('cec_client_port'), inventory=inventory,
+            display_id=display['id'], entity_prefix=display.get('entity_prefix')
+        )
+
+    def _open_backend(self, preference, device, cec_client_port=None):
+        """The CEC backend config asks for: "kernel" (the Linux CEC framework via
+        `device`), "cec-client" (on `cec_client_port` if given, else libcec's first
+        adapter), or "auto" -- kernel if the device opens, else cec-client."""
+        if preference not in ("auto", "kernel", "cec-client"):
+            logging.warning(f"Unknown cec_backend '{preference}'; using auto")
+            preference = "auto"
+        if preference != "cec-client":
+            try:
+                return LinuxCecBackend(device, frame_listener=self._on_cec_frame)
+            except OSError as e:
+                log = logging.error if preference == "kernel" else logging.info
+                log(f"Kernel CEC device {device} unavailable ({e}); falling back to cec-client")
+        if cec_client_port:
+            return CecClientBackend(frame_listener=self._on_cec_frame, command=f"cec-client -d 9 {cec_client_port}")
+        return CecClientBackend(frame_listener=self._on_cec_frame)
+
+    def _run_cec(self, operation, *args, background=False, coalesce=False, group=None, preemptible=False, default=None):
+        """Queue a backend call (e.g. self.backend.power_status) and wait for its result
+        (`default` on failure, or if a newer request replaced it while queued).
+        `coalesce=True` merges it with an identical queued/in-flight call; `group` lets a
+        newer call in the same group replace it while it's still queued; `preemptible`
+        lets a user command abort it mid-flight (see CecCommandQueue)."""
+        future = self.commands.submit(
+            operation, *args,
+            priority=PRIORITY_BACKGROUND if background else PRIORITY_USER,
+            key=(operation.__name__,) + args if coalesce else None, group=group, preemptible=preemptible
+        )
+        try:
+            return future.result()
+        except CancelledError:
+            logging.info(f"CEC {operation.__name__} replaced by a newer {group} request before it ran")
+            return default
+        except Exception:
+            return default  # already logged by CecCommandQueue
+
+    def _begin_request(self, kind):
+        """Start a new power/input request, superseding any older one still confirming.
+        Returns a check for whether this request is still the latest."""
+        with self._request_lock:
+            self._request_generation[kind] += 1
+            generation = self._request_generation[kind]
+        return lambda: self._request_generation[kind] == generation
+
+    def _on_cec_frame(self, frame):
+        """Apply unsolicited bus traffic (e.g. the TV's own remote turning it off or
+        switching input) to TV state and Home Assistant straight away."""
+        if frame.outgoing:
+            return
+        self._last_traffic = time.monotonic()
+        from_tv = frame.initiator == 0
+
+        if frame.opcode == OPCODE_REPORT_POWER_STATUS and from_tv and frame.params:
+            self._observe_power(self.POWER_STATUS_STATES.get(POWER_STATUS_NAMES.get(frame.params[0]), self.POWER_UNKNOWN))
+        elif frame.opcode == OPCODE_STANDBY and from_tv:
+            self._observe_power(self.POWER_OFF)
+        elif frame.opcode == OPCODE_REQUEST_ACTIVE_SOURCE and from_tv:
+            self._observe_power(self.POWER_ON)  # TVs ask who's active as they come out of standby
+        elif frame.opcode == OPCODE_ACTIVE_SOURCE:
+            self._apply_active_address(frame.physical_address())
+        elif frame.opcode == OPCODE_ROUTING_CHANGE:
+            if from_tv:
+                self._observe_power(self.POWER_ON)
+            self._apply_active_address(frame.physical_address(2))  # operands: old path, new path
+        elif frame.opcode == OPCODE_SET_STREAM_PATH:
+            if from_tv:
+                self._observe_power(self.POWER_ON)
+            self._apply_active_address(frame.physical_address())
+
+    @property
+    def is_on(self):
+        """Whether the TV is on as far as anything else is concerned: a TV that's still
+        turning off counts as on, one still turning on doesn't yet."""
+        return self.power_state in (self.POWER_ON, self.POWER_TURNING_OFF)
+
+    def _observe_power(self, observed):
+        """Apply a power state the TV reported (by query or bus traffic). A transition in
+        progress only ends once the TV reaches its target, or its deadline passes."""
+        with self._power_changed:
+            current = self.power_state
+            if current in (self.POWER_TURNING_ON, self.POWER_TURNING_OFF) and time.monotonic() < self._transition_deadline:
+                target = self.POWER_ON if current == self.POWER_TURNING_ON else self.POWER_OFF
+                if observed != target:
+                    return  # still on its way there
+            elif observed in (self.POWER_TURNING_ON, self.POWER_TURNING_OFF):
+                self._transition_deadline = time.monotonic() + self.POWER_TRANSITION_TIMEOUT
+            changed = self._set_power_state(observed)
+        if changed:
+            self._publish_power()
+
+    def _set_power_state(self, state):
+        """Move to `state` (call with _power_changed held). Returns whether that changed
+        is_on, i.e. whether Home Assistant needs to hear about it."""
+        previous, was_on = self.power_state, self.is_on
+        if state == previous:
+            return False
+        self.power_state = state
+        self._power_changed.notify_all()
+        logging.info(f"TV power: {previous} -> {state}")
+        if self.is_on == was_on:
+            return False
+        self._scan_cache = None  # its power/active-source fields are out of date now
+        return True
 
+    def _publish_power(self):
         if self.ha_client:
-            self.ha_client.update_switch("tv_power_switch", "ON" if power_status else "OFF")
-            self.ha_client.update_binary_sensor("tv_power", power_status)
-
+            self.ha_client.update_switch(self._entity("power_switch"), "ON" if self.is_on else "OFF")
+            self.ha_client.update_binary_sensor(self._entity("power"), self.is_on)
         self.update_input()
 
-        return power_status
-
-    def get_power_status(self):
-        """Return the last-known power status without querying the TV again."""
-        return self.is_on
-
-    def toggle_power(self):
-        if self.is_on:
-            logging.info("TV is ON, sending standby command...")
-            self.standby()
-        else:
-            logging.info("TV is OFF, sending power on command...")
-            self.power_on()
-
-    def power_on(self):
-        """Turn on the TV, then confirm it actually turned on."""
-        if self.is_on:
-            logging.info("Power-on request ignored: TV is already ON.")
+    def _apply_active_address(self, physical_address):
+        detected_input = self._input_for_address(physical_address) if physical_address else None
+        with self._active_report_changed:
+            self._active_report = (detected_input, time.monotonic())
+            self._active_report_changed.notify_all()
+        if detected_input is None:
+            logging.info(f"Active source moved to {physical_address}, which isn't a configured input; keeping {self.internal_input}")
             return
-
-        if not self._acquire_for_command("power on"):
-            logging.info("TV command already in progress, ignoring power-on request.")
+        if detected_input == self.internal_input:
             return
+        logging.info(f"TV input changed on the CEC bus: {detected_input} ({physical_address})")
+        self.internal_input = detected_input
+        self._scan_cache = None
+        self.update_input()
 
-        try:
-            logging.info("Sending power-on command to TV...")
-            self._run_cec_command(f"on {self.address}")
-
-            timeout = 60
-            interval = 2
-            elapsed = 0
+    def _input_for_address(self, physical_address):
+        """Key of the configured input `physical_address` sits on -- either the input's
+        own address or a device further down that port (e.g. behind a switch)."""
+        for key, input_config in self.inputs.items():
+            if self._address_within(physical_address, input_config['address']):
+                return key
+        return None
 
-            while elapsed < timeout:
-                time.sleep(interval)
-                elapsed += interval
-                if self.check_power_status():
-                    logging.info("TV successfully powered ON.")
-                    return
+    @staticmethod
+    def _address_within(physical_address, port_address):
+        port = port_address.split('.')
+        depth = max((i + 1 for i, part in enumerate(port) if part != '0'), default=0)
+        return depth > 0 and physical_address.split('.')[:depth] == port[:depth]
+
+    def check_power_status(self, background=False):
+        """Ask the TV whether it's on and apply the answer (Home Assistant only hears
+        about actual changes). Concurrent checks share a single query. Returns whether
+        the TV reported itself on -- or, if it didn't answer, whether it was last known
+        to be."""
+        status = self._run_cec(self.backend.power_status, self.address, self.CEC_TIMEOUT, background=background, coalesce=True)
+
+        logging.info(f"Checking TV power status... Reported: {status}")
+        if status is None:
+            # No answer (timed out, or the query failed) says nothing about the TV
+            logging.info(f"No power status from the TV; keeping {self.power_state}")
+            return self.is_on
+
+        observed = self.POWER_STATUS_STATES.get(status, self.POWER_UNKNOWN)
+        if observed == self.POWER_UNKNOWN:
+            logging.warning("Unexpected power status response, treating TV as OFF.")
+        self._observe_power(observed)
+        return observed == self.POWER_ON
 
-            logging.error("Failed to power ON the TV within the timeout period.")
-        finally:
-            self.lock.release()
+    def get_power_status(self):
+        """Return the last-known power status without querying the TV again."""
+        return self.is_on
 
-    def standby(self):
-        """Put the TV into standby mode, then confirm it actually turned off."""
-        if not self.is_on:
-            logging.info("Standby request ignored: TV is already OFF.")
-            return
+    def toggle_power(self, callback=None):
+        if self.power_state in (self.POWER_ON, self.POWER_TURNING_ON):
+            logging.info("TV is ON (or turning on), sending standby command...")
+            return self.standby(callback)
+        logging.info("TV is OFF, sending power on command...")
+        return self.power_on(callback)
+
+    def power_on(self, callback=None):
+        """Turn on the TV without waiting for it. Returns a Future resolving to whether the
+        TV confirmed it (`callback(future)` also runs then); the command and its
+        confirmation run in the background. A request the TV is already on its way to
+        shares that request's Future; a newer power request replaces this one (see
+        _begin_request) rather than being ignored."""
+        return self._request_power(self.POWER_TURNING_ON, self.POWER_ON, self.backend.power_on,
+                                   "Sending power-on command to TV...", callback)
+
+    def standby(self, callback=None):
+        """Put the TV into standby mode without waiting for it; see power_on()."""
+        return self._request_power(self.POWER_TURNING_OFF, self.POWER_OFF, self.backend.standby,
+                                   "Turning off TV (standby mode)...", callback)
+
+    def _request_power(self, transition, target, operation, message, callback):
+        with self._request_lock:
+            if self._begin_power_transition(transition, target):
+                future = self._in_background(self._send_power, transition, target, operation, message, self._begin_request('power'))
+                self._pending['power'] = future
+            elif self.power_state == target:
+                future = self._completed(True)
+            elif self._pending['power'] is not None and not self._pending['power'].done():
+                future = self._pending['power']
+            else:
+                # The TV started this transition by itself; just wait for it to finish
+                future = self._in_background(self._confirm_power, transition, target, self._begin_request('power'))
+                self._pending['power'] = future
+        if callback:
+            future.add_done_callback(callback)
+        return future
+
+    def _send_power(self, transition, target, operation, message, is_current):
+        logging.info(message)
+        self._run_cec(operation, self.address, self.CEC_TIMEOUT, group='power')
+        return self._confirm_power(transition, target, is_current)
 
-        if not self._acquire_for_command("standby"):
-            logging.info("TV command already in progress, ignoring standby request.")
-            return
+    @staticmethod
+    def _in_background(operation, *args):
+        """Run `operation` on its own daemon thread -- so a confirmation loop can never
+        hold up the caller, nor exit -- returning a Future for its result."""
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(operation(*args))
+            except Exception as e:
+                logging.exception(f"TV command {operation.__name__} failed")
+                future.set_exception(e)
 
-        try:
-            logging.info("Turning off TV (standby mode)...")
-            self._run_cec_command(f"standby {self.address}")
+        threading.Thread(target=run, name=f"tv{operation.__name__}", daemon=True).start()
+        return future
 
-            timeout = 60
-            interval = 5
-            elapsed = 0
+    @staticmethod
+    def _completed(result):
+        future = Future()
+        future.set_result(result)
+        return future
+
+    def _begin_power_transition(self, transition, target):
+        """Enter `transition` unless the TV is already at `target` or on its way there.
+        Returns whether a command needs sending."""
+        with self._power_changed:
+            if self.power_state == target:
+                logging.info(f"Power request ignored: TV is already {target.upper()}.")
+                return False
+            if self.power_state == transition and time.monotonic() < self._transition_deadline:
+                logging.info(f"Power request absorbed: TV is already {transition}.")
+                return False
+            self._transition_deadline = time.monotonic() + self.POWER_TRANSITION_TIMEOUT
+            changed = self._set_power_state(transition)
+        if changed:
+            self._publish_power()
+        return True
+
+    def _confirm_power(self, transition, target, is_current):
+        """Wait for the TV to leave `transition`, normally on its own bus traffic, else on
+        a status check after each POWER_CONFIRM_BACKOFF wait. If it's still stuck when
+        the transition expires, one last check decides what state it's really in."""
+        start = time.monotonic()
+        for attempt in itertools.count():
+            delay = self.POWER_CONFIRM_BACKOFF[min(attempt, len(self.POWER_CONFIRM_BACKOFF) - 1)]
+            with self._power_changed:
+                self._power_changed.wait_for(
+                    lambda: self.power_state != transition,
+                    max(0, min(delay, self._transition_deadline - time.monotonic()))
+                )
+                state = self.power_state
+            if not is_current():
+                logging.info(f"TV {transition} superseded by a newer power request.")
+                return False
+            if state == target:
+                logging.info(f"TV reached {target.upper()} in {time.monotonic() - start:.1f}s.")
+                return True
+            if state != transition:
+                logging.info(f"TV went {state} instead of {target} while {transition}.")
+                return False
+            if time.monotonic() >= self._transition_deadline:
+                break
+            self.check_power_status()
 
-            while elapsed < timeout:
-                time.sleep(interval)
-                elapsed += interval
-                if not self.check_power_status():
-                    logging.info("TV successfully entered standby mode.")
-                    return
+        logging.error(f"TV didn't reach {target.upper()} within {self.POWER_TRANSITION_TIMEOUT}s.")
+        changed = False
+        with self._power_changed:
+            if self.power_state == transition:
+                changed = self._set_power_state(self.POWER_UNKNOWN)  # lets the check below settle it
+        if changed:
+            self._publish_power()
+        self.check_power_status()
+        return False
 
-            logging.error("Failed to put the TV into standby mode within the timeout period.")
-        finally:
-            self.lock.release()
+    def _scan(self, background=False, max_age=None):
+        """A ScanResult no older than `max_age` seconds (default SCAN_CACHE_TTL): the
+        cached one if it's fresh enough, otherwise a new bus scan -- concurrent callers
+        share that one scan too."""
+        max_age = self.SCAN_CACHE_TTL if max_age is None else max_age
+        cached = self._scan_cache
+        if cached is not None and cached.age() <= max_age:
+            return cached
+        scan = self._run_cec(self.backend.scan, self.SCAN_TIMEOUT, background=background, coalesce=True,
+                             preemptible=background, default=ScanResult([]))
+        if scan.devices:  # don't cache (or persist) a timed-out/abandoned scan
+            self._scan_cache = scan
+            self._save_inventory(scan)
+        return scan
 
     def get_active_source(self):
-        """Retrieve and track the currently active HDMI input source (a fresh scan)."""
-        return self._parse_active_source(self._run_cec_command("scan", timeout=self.SCAN_TIMEOUT))
+        """Retrieve and track the currently active HDMI input source."""
+        return self._parse_active_source(self._scan())
 
-    def _parse_active_source(self, output):
-        """Same as get_active_source(), against already-fetched scan output."""
-        match = re.search(r"currently active source:\s*(.+)", output)
-        if not match:
+    def _parse_active_source(self, scan):
+        """Same as get_active_source(), against an already-fetched ScanResult."""
+        source_info = scan.active_source_text
+        if not source_info:
             return "Unknown"
 
-        source_info = match.group(1).strip()
         if "unknown (-1)" in source_info or "TV" in source_info:
             # "TV (0)" also covers a non-CEC source being selected -- CEC can't tell them apart.
             logging.warning(f"TV reports 'unknown (-1)', keeping last known input: {self.internal_input}")
             return self.internal_input
 
-        number_match = re.search(r"\((\d+)\)", source_info)
-        if not number_match:
+        if scan.active_source_number is None:
             return "Unknown"
 
-        device = self._find_device_by_number(output, number_match.group(1))
-        device_name = device.get("osd_string", "Unknown") if device else "Unknown"
-        detected_input = f"HDMI {number_match.group(1)} ({device_name})"
+        device = scan.by_number.get(scan.active_source_number)
+        device_name = (device and device.osd_name) or "Unknown"
+        detected_input = f"HDMI {scan.active_source_number} ({device_name})"
         self.internal_input = detected_input
         logging.info(f"TV detected real input: {detected_input}")
         return detected_input
 
     def get_hdmi_device_name(self):
-        """Name of whatever CEC device is on the "hdmi" input (a fresh scan)."""
-        return self._parse_hdmi_device_name(self._run_cec_command("scan", timeout=self.SCAN_TIMEOUT))
-
-    def _parse_hdmi_device_name(self, output):
-        """Same as get_hdmi_device_name(), against already-fetched scan output. Falls back
-        to the configured default name if nothing CEC-aware is on that port."""
-        device = self._find_device_by_address(output, self.inputs['hdmi']['address'])
-        return (device and device.get('osd_string')) or self.inputs['hdmi']['name']
-
-    @staticmethod
-    def _parse_scan_devices(scan_output):
-        """Parse `cec-client scan` output into a list of per-device dicts."""
-        devices = []
-        current = None
-        for line in scan_output.splitlines():
-            line = line.strip()
-            header = re.match(r"device #(\d+):", line)
-            if header:
-                current = {"number": header.group(1)}
-                devices.append(current)
-                continue
-            if current is None:
-                continue
-            if line.startswith("address:"):
-                current["address"] = line.split(":", 1)[1].strip()
-            elif line.startswith("osd string:"):
-                current["osd_string"] = line.split(":", 1)[1].strip()
-        return devices
-
-    @classmethod
-    def _find_device_by_number(cls, scan_output, number):
-        return next((d for d in cls._parse_scan_devices(scan_output) if d.get("number") == number), None)
+        """Name of whatever CEC device is on the "hdmi" input."""
+        return self._parse_hdmi_device_name(self._scan())
 
-    @classmethod
-    def _find_device_by_address(cls, scan_output, address):
-        return next((d for d in cls._parse_scan_devices(scan_output) if d.get("address") == address), None)
+    def _parse_hdmi_device_name(self, scan):
+        """Same as get_hdmi_device_name(), against an already-fetched ScanResult. Falls
+        back to the configured default name if nothing CEC-aware is on that port."""
+        device = scan.by_address.get(self.inputs['hdmi']['address'])
+        return (device and device.osd_name) or self.inputs['hdmi']['name']
 
     def _apply_hdmi_label(self, label):
         """Update the "TV Input" select's second option if the detected label changed."""
@@ -282,15 +539,22 @@ class TV:
             return
         self._hdmi_label = label
         if self.ha_client:
-            self.ha_client.update_select_options("tv_input", [self.inputs['rPi']['name'], label])
+            self.ha_client.update_select_options(self._entity("input"), [self.inputs['rPi']['name'], label])
 
     def update_input(self):
-        """Push the currently set input source to Home Assistant."""
+        """Push the currently set input source to Home Assistant, if it's changed since
+        the last push."""
         if self.ha_client:
-            self.ha_client.update_sensor("tv_current_input", self.get_current_input())
-            selection = self.get_tv_input_selection()
-            if selection is not None:
-                self.ha_client.update_select("tv_input", selection)
+            current, selection = self.get_current_input(), self.get_tv_input_selection()
+            published_current, published_selection = self._published_input
+            self._published_input = (current, selection)
+            if current != published_current:
+                self.ha_client.update_sensor(self._entity("current_input"), current)
+            if selection is not None and selection != published_selection:
+                self.ha_client.update_select(self._entity("input"), selection)
+            if (current, selection) != (published_current, published_selection):
+                self.ha_client.invalidate("tv_state")  # attributes with depends_on: ["tv_state"]
+        self._save_inventory()
         return self.internal_input
 
     def get_current_input(self):
@@ -308,64 +572,154 @@ class TV:
             return self.inputs['rPi']['name']
         return self._hdmi_label
 
-    def set_input(self, desired_source):
-        """Change the TV input to a specified source (a key in self.inputs)."""
+    def set_input(self, desired_source, callback=None):
+        """Change the TV input to a specified source (a key in self.inputs) without
+        waiting for it. Returns a Future resolving to whether the switch was confirmed
+        (`callback(future)` also runs then); a repeat request for the input already being
+        switched to shares its Future."""
         input_config = self.inputs.get(desired_source)
         if not input_config:
             logging.warning(f"Unknown TV input '{desired_source}'; not switching")
-            return
-
-        if not self._acquire_for_command(f"input switch to {desired_source}"):
-            logging.info(f"TV command already in progress, ignoring input switch to {desired_source}.")
-            return
-
+            future = self._completed(False)
+        else:
+            with self._request_lock:
+                pending = self._pending['input']
+                if self.switching_to == desired_source and pending is not None and not pending.done():
+                    logging.info(f"Already switching TV input to {desired_source}; sharing that request")
+                    future = pending
+                else:
+                    self.switching_to = desired_source
+                    future = self._in_background(self._switch_input, desired_source, input_config, self._begin_request('input'))
+                    self._pending['input'] = future
+        if callback:
+            future.add_done_callback(callback)
+        return future
+
+    def _switch_input(self, desired_source, input_config, is_current):
         try:
             logging.info(f"Switching TV input to {desired_source}")
-            self._run_cec_command(self._active_source_command(input_config['address']))
+            self._run_cec(self.backend.set_active_source, input_config['address'], group='input')
 
             self.internal_input = desired_source
-            self.wait_for_input_switch(desired_source)
+            confirmed = self.wait_for_input_switch(desired_source, is_current=is_current)
             self.update_input()
+            return confirmed
         finally:
-            self.lock.release()
+            if is_current():
+                self.switching_to = None
 
-    @staticmethod
-    def _active_source_command(physical_address):
-        """CEC "tx" command that makes `physical_address` (e.g. "2.0.0.0") active."""
-        nibbles = [int(part) for part in physical_address.split('.')]
-        byte1 = (nibbles[0] << 4) | nibbles[1]
-        byte2 = (nibbles[2] << 4) | nibbles[3]
-        return f"tx 1F:82:{byte1:02X}:{byte2:02X}"
-
-    def set_input_rpi(self):
+    def set_input_by_name(self, name, callback=None):
+        """Callback for a "TV Input" select: anything but the Pi's name maps to hdmi."""
+        return self.set_input('rPi' if name == self.inputs['rPi']['name'] else 'hdmi', callback)
+
+    def set_input_rpi(self, callback=None):
         logging.info("Setting TV input to rPi...")
-        self.set_input('rPi')
+        return self.set_input('rPi', callback)
 
-    def set_input_hdmi(self):
+    def set_input_hdmi(self, callback=None):
         logging.info("Setting TV input to HDMI...")
-        self.set_input('hdmi')
-
-    def wait_for_input_switch(self, desired_source, timeout=25, interval=2):
-        """Poll the input status every `interval` seconds until `timeout` is reached."""
+        return self.set_input('hdmi', callback)
+
+    def wait_for_input_switch(self, desired_source, timeout=None, is_current=None):
+        """Confirm an input switch with directed queries rather than full bus scans: ask
+        the TV's power status once, then broadcast <Request Active Source> on a backoff
+        (INPUT_CONFIRM_BACKOFF), returning as soon as a device's reply (applied by
+        _on_cec_frame) names `desired_source`, or once nothing has contradicted the switch
+        for INPUT_UNCONTESTED_AFTER. Stops early if a newer input request supersedes this
+        one (`is_current` returns False). A TV still turning on is waited for first. Records
+        the time a bus-confirmed switch took in last_input_switch_seconds, and every
+        outcome in input_switch_outcomes."""
+        timeout = timeout or self.INPUT_CONFIRM_TIMEOUT
         logging.info(f"Waiting for TV to switch to {desired_source}...")
+
+        with self._power_changed:
+            # It can't switch input until it's up, and the transition ends when it is
+            while (self.power_state == self.POWER_TURNING_ON and time.monotonic() < self._transition_deadline
+                   and (not is_current or is_current())):
+                self._power_changed.wait(1)
         start = time.monotonic()
-        while time.monotonic() - start < timeout:
-            time.sleep(interval)
-            detected_input = self.get_active_source()
-
-            if desired_source == "hdmi":
-                if detected_input not in ("Unknown", "rPi"):
-                    logging.info(f"TV detected real input: {detected_input}")
-                    return True
-            elif self.internal_input == desired_source:
-                logging.info(f"TV successfully switched to {desired_source} after {time.monotonic() - start:.1f}s")
-                return True
 
-        logging.warning(f"TV input switch to {desired_source} timed out after {timeout}s. Keeping last attempted input: {desired_source}")
+        if not self.check_power_status():
+            logging.info(f"TV is off; input {desired_source} will apply once it's turned on")
+            return False
+
+        contested = False
+        for attempt in itertools.count():
+            elapsed = time.monotonic() - start
+            if elapsed >= timeout:
+                break
+            if is_current and not is_current():
+                logging.info(f"Input switch to {desired_source} superseded by a newer input request.")
+                return False
+
+            reported_input, reported_at = self._active_report
+            if reported_at >= start:
+                if reported_input == desired_source:
+                    return self._record_input_switch(desired_source, start, 'confirmed')
+                contested = True
+            elif not contested and elapsed >= self.INPUT_UNCONTESTED_AFTER:
+                return self._record_input_switch(desired_source, start, 'uncontested')
+
+            self._run_cec(self.backend.request_active_source, coalesce=True)
+            delay = self.INPUT_CONFIRM_BACKOFF[min(attempt, len(self.INPUT_CONFIRM_BACKOFF) - 1)]
+            if not contested:
+                delay = min(delay, max(0.05, self.INPUT_UNCONTESTED_AFTER - (time.monotonic() - start)))
+            with self._active_report_changed:
+                if self._active_report[1] == reported_at:  # nothing new arrived during the probe itself
+                    self._active_report_changed.wait(min(delay, max(0, timeout - elapsed)))
+
+        logging.warning(f"TV input switch to {desired_source} not confirmed after {timeout}s. Keeping last attempted input: {desired_source}")
+        self.input_switch_outcomes['unconfirmed'] += 1
+        if self.ha_client:
+            self.ha_client.invalidate("tv_state")  # the sensor's "outcomes" attribute
         self.internal_input = desired_source
         return False
 
-    def rotate_input(self):
+    def _record_input_switch(self, desired_source, start, outcome):
+        """Count a switch as 'confirmed' (a device reported the new active source) or
+        'uncontested' (nothing answered either way); only a confirmed one is timed."""
+        seconds = round(time.monotonic() - start, 2)
+        self.input_switch_outcomes[outcome] += 1
+        if self.ha_client:
+            # Its "outcomes" attribute changes even when the input already showed this one
+            self.ha_client.invalidate("tv_state")
+        if outcome != 'confirmed':
+            logging.info(f"TV switch to {desired_source} uncontested after {seconds}s; assuming it took")
+            return True
+        self.last_input_switch_seconds = seconds
+        logging.info(f"TV switched to {desired_source} in {seconds}s (confirmed by the active source)")
+        if self.ha_client:
+            self.ha_client.update_sensor(self._entity("input_switch_time"), seconds)
+        return True
+
+    def get_last_input_switch_time(self):
+        """Seconds the last bus-confirmed input switch took, for the "TV Input Switch
+        Time" sensor, or None if there hasn't been one yet."""
+        return self.last_input_switch_seconds
+
+    def get_input_switch_outcomes(self):
+        """How many input switches were confirmed, uncontested or never confirmed."""
+        return dict(self.input_switch_outcomes)
+
+    def rotate_input(self, callback=None):
         logging.info(f"Rotating TV input. Current: {self.internal_input}")
         new_input = 'hdmi' if self.internal_input == 'rPi' else 'rPi'
-        self.set_input(new_input)
+        return self.set_input(new_input, callback)
+
+
+def display_configs(config):
+    """config.yaml's `displays` list, or -- for a config without one -- a single "tv"
+    display built from the top-level tv_inputs/cec_backend/cec_device settings."""
+    displays = config.get('displays')
+    if not displays:
+        displays = [{
+            'id': "tv",
+            'inputs': config.get('tv_inputs'),
+            'cec_backend': config.get('cec_backend', "auto"),
+            'cec_device': config.get('cec_device', "/dev/cec0"),
+        }]
+    ids = [display['id'] for display in displays]
+    duplicates = sorted({display_id for display_id in ids if ids.count(display_id) > 1})
+    if duplicates:
+        raise ValueError(f"Duplicate display id(s) in config.yaml: {', '.join(duplicates)}")
+    return displays
@@ -1,3 +1,4 @@
+import concurrent.futures
 import psutil
 import logging
 import os
@@ -27,17 +28,29 @@ def format_duration(seconds):
 
 VOLUME_SINK = "@DEFAULT_AUDIO_SINK@"  # PipeWire's alias for the system default output
 VOLUME_WATCH_DEBOUNCE = 0.3  # seconds to coalesce a burst of "change" events into one recheck
+SHUTDOWN_STANDBY_TIMEOUT = 15  # seconds shutdown() waits for the TV to confirm standby
+SNAPSHOT_MAX_AGE = 1.0  # seconds a system snapshot is reused outside a refresh batch (e.g. at startup)
+# What Utils._system_snapshot reads, by name
+SYSTEM_METRICS = {
+    'cpu_temperature': lambda: psutil.sensors_temperatures()['cpu_thermal'][0].current,
+    'memory': lambda: psutil.virtual_memory().percent,
+    'swap': lambda: psutil.swap_memory().percent,
+    'disk': lambda: psutil.disk_usage('/').percent,
+}
 
 
 class Utils:
-    def __init__(self, config, secrets, supervisor, tv, buttons=None, ha_client=None):
+    def __init__(self, config, secrets, supervisor, tv, buttons=None, ha_client=None, displays=None):
         self.config = config
         self.secrets = secrets
         self.supervisor = supervisor
         self.tv = tv
+        self.displays = displays or [tv]  # every display, put into standby together on shutdown
         self.buttons = buttons or []
         self.ha_client = ha_client
         self._start_time = time.monotonic()  # for the "Supervisor Uptime" sensor
+        self._snapshot = None  # (monotonic time read, {metric: value}); see _system_snapshot
+        self._snapshot_lock = threading.Lock()
 
         self.hw_info = self.get_hw_info()
         self.sw_info = self.get_sw_info()
@@ -96,17 +109,39 @@ class Utils:
         logger.warning(f"No network connection detected after waiting {timeout}s")
         return False
 
+    def begin_refresh_batch(self):
+        """Called by the RefreshScheduler before each batch: the first system getter in
+        it takes a fresh snapshot, and the rest of the batch reads that same one."""
+        with self._snapshot_lock:
+            self._snapshot = None
+
+    def _system_snapshot(self):
+        """Everything the system sensors report (CPU temperature, memory, swap and disk
+        usage), read from psutil together once and shared by their getters. A metric that
+        can't be read (e.g. no temperature sensor) is None; the others are unaffected."""
+        with self._snapshot_lock:
+            if self._snapshot is None or time.monotonic() - self._snapshot[0] >= SNAPSHOT_MAX_AGE:
+                values = {}
+                for name, read in SYSTEM_METRICS.items():
+                    try:
+                        values[name] = read()
+                    except Exception as e:
+                        logger.warning(f"Couldn't read {name}: {e}")
+                        values[name] = None
+                self._snapshot = (time.monotonic(), values)
+            return self._snapshot[1]
+
     def get_cpu_temperature(self):
-        return psutil.sensors_temperatures()['cpu_thermal'][0].current
+        return self._system_snapshot()['cpu_temperature']
 
     def get_memory_usage(self):
-        return psutil.virtual_memory().percent
+        return self._system_snapshot()['memory']
 
     def get_swap_usage(self):
-        return psutil.swap_memory().percent
+        return self._system_snapshot()['swap']
 
     def get_disk_usage(self):
-        return psutil.disk_usage('/').percent
+        return self._system_snapshot()['disk']
 
     def get_volume(self):
         """Current system output volume (0-100), read via PipeWire's default sink.
@@ -249,9 +284,12 @@ class Utils:
         os.system("sudo reboot")
 
     def shutdown(self):
-        """Shut down the system."""
+        """Shut down the system, once every display has confirmed standby (or given up trying)."""
         logger.warning("Shutting down the system!")
-        self.tv.standby()
+        standbys = [display.standby() for display in self.displays]  # all at once, each on its own adapter
+        _, unconfirmed = concurrent.futures.wait(standbys, timeout=SHUTDOWN_STANDBY_TIMEOUT)
+        if unconfirmed:
+            logger.warning(f"{len(unconfirmed)} display(s) didn't confirm standby before shutdown")
         os.system("sudo shutdown -h now")
 
     def cleanup_gpios(self):
@@ -0,0 +1,44 @@
+import queue
+import threading
+from concurrent.futures import Future
+
+class WorkerPool:
+    """A fixed number of threads running submitted calls, a Future per call -- like a
+    concurrent.futures.ThreadPoolExecutor, but with daemon threads. The interpreter
+    joins an executor's workers at exit, so one call hung on the TV or the broker would
+    keep the process alive. ShutdownCoordinator.exit() would force it out at the
+    deadline, but only on the signal path: an exception escaping main() at startup
+    exits the ordinary way."""
+
+    def __init__(self, workers, name):
+        self._jobs = queue.SimpleQueue()  # (future, fn, args), or None to stop a worker
+        self._workers = workers
+        for number in range(workers):
+            threading.Thread(target=self._work, name=f"{name}-{number}", daemon=True).start()
+
+    def submit(self, fn, *args):
+        future = Future()
+        self._jobs.put((future, fn, args))
+        return future
+
+    def _work(self):
+        while (job := self._jobs.get()) is not None:
+            future, fn, args = job
+            if not future.set_running_or_notify_cancel():
+                continue
+            try:
+                future.set_result(fn(*args))
+            except Exception as e:
+                future.set_exception(e)
+
+    def shutdown(self, cancel_pending=False):
+        """Stop the workers once the calls already queued are done -- or, with
+        `cancel_pending`, cancel those first. Running calls aren't waited for."""
+        if cancel_pending:
+            try:
+                while (job := self._jobs.get_nowait()) is not None:
+                    job[0].cancel()
+            except queue.Empty:
+                pass
+        for _ in range(self._workers):
+            self._jobs.put(None)
@@ -1,18 +1,18 @@
 import logging
 import os
-import sys
 import time
 import yaml
 import pygame
 import signal
 from signal import pause
 from types import SimpleNamespace
-from app.tv import TV
+from app.tv import TV, display_configs
 from app.buttons import load_buttons
 from app.home_assistant_client import HomeAssistantClient
 from app.supervisor import Supervisor
 from app.utils import Utils
 from app.settings_store import SettingsStore
+from app.shutdown import ShutdownCoordinator
 
 # Load configuration from YAML files
 with open('config/config.yaml', 'r') as config_file:
@@ -63,16 +63,31 @@ sounds = {
 }
 
 supervisor = None  # guards signal_handler if a signal arrives before main() sets this up
+displays = {}
 
 def signal_handler(sig, frame):
     logger.info('Signal received, exiting...')
+    # Every phase runs at once; the app and services get most of the deadline to exit
+    # on SIGTERM (so 2s by default, not their usual 5s -- raise shutdown_deadline for an
+    # app that needs longer), leaving time to SIGKILL anything that doesn't
+    shutdown = ShutdownCoordinator(config.get('shutdown_deadline', ShutdownCoordinator.DEADLINE))
+    grace = max(shutdown.deadline - 1, 0.5)
     if ha_client:
-        ha_client.cleanup()
+        shutdown.add("mqtt", ha_client.cleanup, timeout=grace)
     if supervisor:
-        supervisor.apps.stop()  # avoid leaking the running app's process group across a restart
-        supervisor.services.stop_all()
-    utils.cleanup_gpios()
-    sys.exit(0)
+        shutdown.add("apps", supervisor.apps.stop, timeout=grace)  # avoid leaking the running app's process group across a restart
+        shutdown.add("services", supervisor.services.stop_all, timeout=grace)
+    shutdown.add("gpio", utils.cleanup_gpios)
+    # cec-client runs in its own session (so it survives our restart) and the kernel
+    # backend holds /dev/cecN open; release both
+    for display_id, display in displays.items():
+        shutdown.add(f"cec-{display_id}", close_cec, display)
+    shutdown.run()
+    shutdown.exit(0)
+
+def close_cec(display):
+    display.backend.abort()  # a command in progress would otherwise hold the session until it times out
+    display.backend.close()
 
 def main():
     """Main function to initialize the system."""
@@ -82,11 +97,17 @@ def main():
     signal.signal(signal.SIGINT, signal_handler)
     signal.signal(signal.SIGTERM, signal_handler)
 
-    # Initialize TV
-    global tv
-    step_start = time.monotonic()
-    tv = TV("0.0.0.0", ha_client=None, inputs=config.get('tv_inputs'))
-    logger.info(f"TV initialized ({time.monotonic() - step_start:.1f}s)")
+    # Initialize displays, each on its own CEC adapter/queue. The first one is "tv" to
+    # everything else (entities.yaml, buttons.yaml, the supervisor).
+    global tv, displays
+    displays = {}
+    for display in display_configs(config):
+        step_start = time.monotonic()
+        # Last known devices/input/power, so the display's state is right immediately at boot
+        inventory = SettingsStore(f"data/{display['id']}_inventory.yaml")
+        displays[display['id']] = TV.from_config(display, inventory=inventory)
+        logger.info(f"Display '{display['id']}' initialized ({time.monotonic() - step_start:.1f}s)")
+    tv = next(iter(displays.values()))
 
     # Initialize Supervisor
     global supervisor
@@ -111,14 +132,15 @@ def main():
         secrets=secrets,
         supervisor=supervisor,
         tv=tv,
-        buttons=None
+        buttons=None,
+        displays=list(displays.values())
     )
     supervisor.utils = utils  # Set utils in supervisor
     logger.info("Utils initialized")
 
     # Initialize Buttons from config/buttons.yaml
     global buttons
-    button_context = SimpleNamespace(tv=tv, supervisor=supervisor, utils=utils)
+    button_context = SimpleNamespace(tv=tv, displays=SimpleNamespace(**displays), supervisor=supervisor, utils=utils)
     buttons = load_buttons('config/buttons.yaml', button_context)
     utils.buttons = buttons
     logger.info(f"Buttons initialized ({len(buttons)})")
@@ -141,15 +163,20 @@ def main():
             entities=entities,
             supervisor=supervisor,
             tv=tv,
-            utils=utils
+            utils=utils,
+            displays=displays,
+            discovery_store=SettingsStore('data/discovery.yaml')
         )
         supervisor.ha_client = ha_client  # Set ha_client in supervisor
-        tv.ha_client = ha_client  # Set ha_client in TV
+        for display in displays.values():
+            display.ha_client = ha_client  # Set ha_client in each display
         utils.ha_client = ha_client  # Set ha_client in Utils
         logger.info(f"HomeAssistantClient constructed ({time.monotonic() - step_start:.1f}s)")
 
         step_start = time.monotonic()
         ha_client.setup_discovery()
+        for display in displays.values():
+            display.publish_state()  # provisional (restored) state until its startup checks finish
         logger.info(f"Home Assistant integration initialized ({time.monotonic() - step_start:.1f}s)")
     except Exception:
         logger.exception("Failed to initialize Home Assistant integration; continuing in offline mode")